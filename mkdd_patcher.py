@@ -176,7 +176,7 @@ class MKDDPatcherApp(customtkinter.CTk):
             title='Select Input ISO',
             initialdir=initialdir,
             initialfile=initialfile,
-            filetypes=(('GameCube Disc Image', '*.iso *.gcm'), ),
+            filetypes=(('GameCube Disc Image', '*.iso *.gcm *.gcz *.ciso'), ),
         )
 
         if not input_iso:
@@ -189,6 +189,8 @@ class MKDDPatcherApp(customtkinter.CTk):
 
         if not self.output_iso_entry.get():
             stem, ext = os.path.splitext(input_iso)
+            if ext.lower() in ('.gcz', '.ciso'):
+                ext = '.iso'  # The output is always an uncompressed ISO
             output_iso = f'{stem}_new{ext}'
             self._last_output_iso_picked = output_iso
             self.output_iso_entry.insert(0, output_iso)
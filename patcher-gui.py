@@ -56,7 +56,7 @@ class ChooseFilePath(tk.Frame):
             path = filedialog.askopenfilename(
                 initialdir=initialdir,
                 title="Choose a MKDD GCM/ISO",
-                filetypes=(("GameCube Disc Image", "*.iso *.gcm"), ))
+                filetypes=(("GameCube Disc Image", "*.iso *.gcm *.gcz *.ciso"), ))
 
         #log.info("path:" ,path)
         if path:
@@ -0,0 +1,101 @@
+import os
+import hashlib
+import logging
+import tempfile
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 512*1024*1024 # 512 MiB
+TEMP_SUFFIX = ".tmp" # Entries that are still being written
+
+
+class CompressionCache(object):
+    """On-disk cache for compression results.
+
+    Entries are keyed by a hash of the uncompressed data and the compression settings, so the same
+    archive compressed with the same settings is only ever compressed once. When the cache grows
+    past max_size, the least recently used entries are removed.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def key(data, setting):
+        hash = hashlib.sha1(setting.encode("ascii"))
+        hash.update(b"\x00")
+        hash.update(data)
+        return hash.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, data, setting):
+        """Returns the cached result for data compressed with setting, or None if it isn't cached."""
+        entry_path = self._entry_path(self.key(data, setting))
+        try:
+            with open(entry_path, "rb") as f:
+                result = f.read()
+        except FileNotFoundError:
+            return None
+
+        # The modification time is used as the last time the entry was used.
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+
+        log.debug(f"Compression cache hit: {entry_path}")
+        return result
+
+    def put(self, data, setting, result):
+        entry_path = self._entry_path(self.key(data, setting))
+        entry_dir = os.path.dirname(entry_path)
+        os.makedirs(entry_dir, exist_ok=True)
+
+        # Write to a temporary file first so that other processes never see a partially written entry.
+        handle, temp_path = tempfile.mkstemp(suffix=TEMP_SUFFIX, dir=entry_dir)
+        try:
+            with os.fdopen(handle, "wb") as f:
+                f.write(result)
+            os.replace(temp_path, entry_path)
+        except:
+            os.remove(temp_path)
+            raise
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total_size = 0
+
+        for entry_dir in os.scandir(self.path):
+            if not entry_dir.is_dir():
+                continue
+            for entry in os.scandir(entry_dir.path):
+                # Entries that are being written can't be removed, and other processes can remove entries at any time
+                if entry.name.endswith(TEMP_SUFFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+
+        if total_size <= self.max_size:
+            return
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            log.debug(f"Evicted {path} from compression cache")
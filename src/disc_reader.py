@@ -0,0 +1,272 @@
+import os
+import mmap
+import zlib
+import threading
+from collections import OrderedDict
+from struct import unpack, unpack_from
+
+# Readers for the disc image formats GCM can read from. Every reader gives random access to the uncompressed
+# data of the disc, no matter how it's stored.
+
+GCZ_MAGIC = 0xB10BC001
+GCZ_UNCOMPRESSED_BLOCK_FLAG = 1 << 63
+
+CISO_MAGIC = b"CISO"
+CISO_HEADER_SIZE = 0x8000
+CISO_MAP_SIZE = CISO_HEADER_SIZE - 8
+
+DEFAULT_BLOCK_CACHE_SIZE = 16*1024*1024 # 16MB of decompressed blocks
+
+def open_disc(path, block_cache_size=DEFAULT_BLOCK_CACHE_SIZE):
+  # Returns a reader for the disc image at path, depending on its format.
+  with open(path, "rb") as f:
+    magic = f.read(4)
+
+  if len(magic) == 4 and unpack("<I", magic)[0] == GCZ_MAGIC:
+    return GCZDiscReader(path, block_cache_size)
+  elif magic == CISO_MAGIC:
+    return CISODiscReader(path, block_cache_size)
+  else:
+    return RawDiscReader(path)
+
+class DiscReader:
+  # Base class of all disc readers.
+  def __init__(self, path):
+    self.path = path
+    self.size = 0
+
+  def read(self, offset, size):
+    # Returns size bytes at offset. Data past the end of the disc reads as zeroes.
+    raise NotImplementedError()
+
+  def view(self, offset, size):
+    # Like read, but avoids copying the data if the reader can.
+    return memoryview(self.read(offset, size))
+
+  def fileno(self):
+    # The file descriptor the disc's data can be copied from as it is, or None if it's stored compressed.
+    return None
+
+  def close(self):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+class RawDiscReader(DiscReader):
+  # Uncompressed ISO/GCM images. The image is mapped into memory, and file data is accessed through
+  # memoryview slices of the mapping, which avoids copying the data and can be shared between threads.
+  def __init__(self, path):
+    super().__init__(path)
+
+    # The file is kept open as well so that data can be copied from it in the kernel.
+    self.file = open(path, "rb")
+    self.size = os.fstat(self.file.fileno()).st_size
+    self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    self.data = memoryview(self.mmap)
+
+  def read(self, offset, size):
+    data = bytes(self.data[offset:offset+size])
+    if len(data) < size:
+      data += b"\0"*(size - len(data))
+    return data
+
+  def view(self, offset, size):
+    if offset + size > self.size:
+      return super().view(offset, size)
+    return self.data[offset:offset+size]
+
+  def fileno(self):
+    return self.file.fileno()
+
+  def close(self):
+    if self.mmap is None:
+      return
+
+    self.data.release()
+    self.data = None
+    try:
+      self.mmap.close()
+    except BufferError:
+      # Views of file data are still in use, the mapping is closed once they are garbage collected.
+      pass
+    self.mmap = None
+    self.file.close()
+
+class BlockDiscReader(DiscReader):
+  # Base class of formats that store the disc in blocks of a fixed size which can be read separately.
+  # The most recently used blocks are kept in a cache, since reads are often close to each other.
+  def __init__(self, path, block_cache_size=DEFAULT_BLOCK_CACHE_SIZE):
+    super().__init__(path)
+
+    self.file = open(path, "rb")
+    self.file_lock = threading.Lock()
+    self.block_size = None
+    self.block_cache_size = block_cache_size
+    self.block_cache = OrderedDict()
+    self.block_cache_lock = threading.Lock()
+
+  def read_block_data(self, block_index):
+    # Returns the decompressed data of a block, which must be block_size bytes long.
+    raise NotImplementedError()
+
+  def read_file(self, offset, size):
+    # Reads from the compressed file, can be used from several threads at once
+    if hasattr(os, "pread"):
+      return os.pread(self.file.fileno(), size, offset)
+
+    with self.file_lock:
+      self.file.seek(offset)
+      return self.file.read(size)
+
+  def get_block(self, block_index):
+    with self.block_cache_lock:
+      if block_index in self.block_cache:
+        self.block_cache.move_to_end(block_index)
+        return self.block_cache[block_index]
+
+    # Decompressed outside of the lock so that several blocks can be decompressed at once
+    data = self.read_block_data(block_index)
+
+    with self.block_cache_lock:
+      self.block_cache[block_index] = data
+      while len(self.block_cache)*self.block_size > self.block_cache_size and len(self.block_cache) > 1:
+        self.block_cache.popitem(last=False)
+
+    return data
+
+  def read(self, offset, size):
+    result = bytearray(size)
+    end = min(offset + size, self.size)
+
+    position = offset
+    while position < end:
+      block_index = position // self.block_size
+      block_offset = position - block_index*self.block_size
+      chunk_size = min(self.block_size - block_offset, end - position)
+
+      block = self.get_block(block_index)
+      result[position-offset:position-offset+chunk_size] = block[block_offset:block_offset+chunk_size]
+      position += chunk_size
+
+    return result
+
+  def close(self):
+    self.file.close()
+    self.block_cache.clear()
+
+class GCZDiscReader(BlockDiscReader):
+  # Dolphin's compressed format, in which every block is compressed with zlib separately.
+  # The header is followed by the offsets of all blocks and their Adler-32 checksums.
+  def __init__(self, path, block_cache_size=DEFAULT_BLOCK_CACHE_SIZE):
+    super().__init__(path, block_cache_size)
+
+    header = self.read_file(0, 0x20)
+    magic, sub_type, self.compressed_size, self.size, self.block_size, num_blocks = unpack("<IIQQII", header)
+    if magic != GCZ_MAGIC:
+      raise Exception("Invalid GCZ header")
+
+    self.block_offsets = unpack_from("<%dQ" % num_blocks, self.read_file(0x20, num_blocks*8))
+    self.data_offset = 0x20 + num_blocks*8 + num_blocks*4
+
+  def read_block_data(self, block_index):
+    block_offset = self.block_offsets[block_index]
+    is_compressed = (block_offset & GCZ_UNCOMPRESSED_BLOCK_FLAG) == 0
+    block_offset &= ~GCZ_UNCOMPRESSED_BLOCK_FLAG
+
+    if block_index + 1 < len(self.block_offsets):
+      block_end = self.block_offsets[block_index+1] & ~GCZ_UNCOMPRESSED_BLOCK_FLAG
+    else:
+      block_end = self.compressed_size
+
+    data = self.read_file(self.data_offset + block_offset, block_end - block_offset)
+    if is_compressed:
+      data = zlib.decompress(data)
+
+    if len(data) != self.block_size:
+      if block_index + 1 < len(self.block_offsets) or len(data) > self.block_size:
+        raise Exception("GCZ block %d has the wrong size" % block_index)
+      data += b"\0"*(self.block_size - len(data))
+    return data
+
+class CISODiscReader(BlockDiscReader):
+  # Compact ISO, which leaves out blocks that are all zero. The header has a map of which blocks
+  # are stored, and the stored blocks follow it in order.
+  def __init__(self, path, block_cache_size=DEFAULT_BLOCK_CACHE_SIZE):
+    super().__init__(path, block_cache_size)
+
+    header = self.read_file(0, CISO_HEADER_SIZE)
+    if header[:4] != CISO_MAGIC:
+      raise Exception("Invalid CISO header")
+    self.block_size = unpack_from("<I", header, 4)[0]
+
+    # Position of every block in the file, or None for blocks that aren't stored
+    self.block_positions = []
+    stored_blocks = 0
+    last_stored_block = -1
+    for block_index, is_stored in enumerate(header[8:8+CISO_MAP_SIZE]):
+      if is_stored:
+        self.block_positions.append(CISO_HEADER_SIZE + stored_blocks*self.block_size)
+        stored_blocks += 1
+        last_stored_block = block_index
+      else:
+        self.block_positions.append(None)
+
+    # The map has room for far more blocks than a disc has, so the disc ends with the last block that is stored.
+    # Zero blocks after it aren't stored, but reads past the end return zeroes anyway.
+    self.size = (last_stored_block + 1)*self.block_size
+
+  def read_block_data(self, block_index):
+    position = self.block_positions[block_index]
+    if position is None:
+      return bytes(self.block_size)
+
+    data = self.read_file(position, self.block_size)
+    if len(data) < self.block_size:
+      data += b"\0"*(self.block_size - len(data))
+    return data
+
+class DiscReaderFile:
+  # Read-only file-like object over a disc reader, for the fs_helpers read functions.
+  def __init__(self, disc):
+    self.disc = disc
+    self.position = 0
+
+  def seek(self, offset, whence=0):
+    if whence == 0:
+      self.position = offset
+    elif whence == 1:
+      self.position += offset
+    elif whence == 2:
+      self.position = self.disc.size + offset
+    return self.position
+
+  def tell(self):
+    return self.position
+
+  def read(self, size=-1):
+    if size is None or size < 0:
+      size = self.disc.size - self.position
+    size = max(0, min(size, self.disc.size - self.position))
+    data = bytes(self.disc.read(self.position, size))
+    self.position += size
+    return data
+
+class DiscRange:
+  # A range of a disc's data that is only read when it's sliced, so that it can stand in for the data.
+  def __init__(self, disc, offset, size):
+    self.disc = disc
+    self.offset = offset
+    self.size = size
+
+  def __len__(self):
+    return self.size
+
+  def __getitem__(self, index):
+    start, stop, step = index.indices(self.size)
+    if step != 1:
+      raise ValueError("DiscRange only supports contiguous slices")
+    return self.disc.view(self.offset + start, max(0, stop - start))
@@ -28,11 +28,29 @@ SOFTWARE.
 """
 
 import os
-from io import BytesIO
+import json
+import zlib
+import hashlib
+import threading
+from io import BytesIO, UnsupportedOperation
+from bisect import bisect_right
+from collections import deque
+from struct import pack, pack_into, unpack_from, iter_unpack
+from concurrent.futures import ThreadPoolExecutor
 
 from .fs_helpers import *
+from .disc_reader import open_disc, DiscRange, DiscReaderFile, GCZ_MAGIC, GCZ_UNCOMPRESSED_BLOCK_FLAG
 
 MAX_DATA_SIZE_TO_READ_AT_ONCE = 64*1024*1024 # 64MB
+ISO_SIZE_ALIGNMENT = 2048*16
+ZERO_BLOCK_SIZE = 0x8000 # Size of the blocks checked for being all zero when skipping zero blocks
+HASH_CHUNK_SIZE = 16*1024*1024
+
+# GCZ is Dolphin's compressed disc format: the disc is split into blocks that are compressed with zlib separately,
+# with a table of the offsets of all blocks after the header.
+GCZ_HEADER_SIZE = 0x20
+GCZ_DEFAULT_BLOCK_SIZE = 0x8000
+GCZ_BLOCKS_PER_JOB = 64
 
 class GCM:
   def __init__(self, iso_path):
@@ -42,9 +60,34 @@ class GCM:
     self.dirs_by_path = {}
     self.dirs_by_path_lowercase = {}
     self.changed_files = {}
+    # The same file object can be used for more than one path, so changed files are only read by one thread at a time
+    self.changed_files_lock = threading.Lock()
+    
+    self.disc = None
+  
+  def open_iso(self):
+    # The input disc is opened once and kept open until close is called. It can be a raw ISO or
+    # compressed as GCZ or CISO, see disc_reader. For raw ISOs, file data is accessed through memoryview
+    # slices of the mapped ISO, which avoids reopening the ISO and copying the data for every read.
+    if self.disc is None:
+      self.disc = open_disc(self.iso_path)
+  
+  def close(self):
+    if self.disc is None:
+      return
+    
+    self.disc.close()
+    self.disc = None
+  
+  def __enter__(self):
+    return self
+  
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
   
   def read_entire_disc(self):
-    self.iso_file = open(self.iso_path, "rb")
+    self.open_iso()
+    self.iso_file = DiscReaderFile(self.disc)
     
     try:
       self.fst_offset = read_u32(self.iso_file, 0x424)
@@ -52,7 +95,6 @@ class GCM:
       self.read_filesystem()
       self.read_system_data()
     finally:
-      self.iso_file.close()
       self.iso_file = None
     
     for file_path, file_entry in self.files_by_path.items():
@@ -61,13 +103,27 @@ class GCM:
       self.dirs_by_path_lowercase[dir_path.lower()] = file_entry
   
   def read_filesystem(self):
-    self.file_entries = []
-    num_file_entries = read_u32(self.iso_file, self.fst_offset + 8)
+    # The whole FST is read at once, the file entries are unpacked in bulk and the FNT is split into names once.
+    fst = read_bytes(self.iso_file, self.fst_offset, self.fst_size)
+    num_file_entries = unpack_from(">I", fst, 8)[0]
     self.fnt_offset = self.fst_offset + num_file_entries*0xC
-    for file_index in range(num_file_entries):
-      file_entry_offset = self.fst_offset + file_index * 0xC
-      file_entry = FileEntry()
-      file_entry.read(file_index, self.iso_file, file_entry_offset, self.fnt_offset)
+    fnt = fst[num_file_entries*0xC:]
+    names = split_name_table(fnt)
+    
+    self.file_entries = []
+    records = iter_unpack(">III", fst[:num_file_entries*0xC])
+    for file_index, (is_dir_and_name_offset, file_data_offset_or_parent_fst_index, file_size_or_next_fst_index) in enumerate(records):
+      name_offset = is_dir_and_name_offset & 0x00FFFFFF
+      if file_index == 0:
+        name = "" # Root
+      elif name_offset in names:
+        name = names[name_offset]
+      else:
+        # Name that starts in the middle of another name or isn't in the FST
+        name = read_str_until_null_character(self.iso_file, self.fnt_offset + name_offset)
+      
+      file_entry = FileEntry.from_record(file_index, is_dir_and_name_offset, file_data_offset_or_parent_fst_index,
+                                         file_size_or_next_fst_index, name)
       self.file_entries.append(file_entry)
     
     root_file_entry = self.file_entries[0]
@@ -135,31 +191,48 @@ class GCM:
       self.files_by_path["sys/fst.bin"],
     ]
   
-  def read_file_data(self, file_path):
+  def get_file_entry_view(self, file_entry):
+    # Returns a read-only memoryview of the file's data in the input ISO, without copying it if the ISO isn't compressed.
+    self.open_iso()
+    return self.disc.view(file_entry.file_data_offset, file_entry.file_size)
+  
+  def iter_file_entry_chunks(self, file_entry, start=0, chunk_size=MAX_DATA_SIZE_TO_READ_AT_ONCE):
+    # Yields the offset and a view of every chunk of the file's data from start on,
+    # so that very large files are never in memory all at once even if the ISO is compressed.
+    self.open_iso()
+    for offset in range(start, file_entry.file_size, chunk_size):
+      size = min(chunk_size, file_entry.file_size - offset)
+      with self.disc.view(file_entry.file_data_offset + offset, size) as data:
+        yield offset, data
+  
+  def get_file_entry_range(self, file_entry):
+    # Returns the file's data in the input ISO as a DiscRange, which is only read when it's sliced.
+    self.open_iso()
+    return DiscRange(self.disc, file_entry.file_data_offset, file_entry.file_size)
+  
+  def get_file_view(self, file_path):
     file_path = file_path.lower()
     if file_path not in self.files_by_path_lowercase:
       raise Exception("Could not find file: " + file_path)
     
     file_entry = self.files_by_path_lowercase[file_path]
-    if file_entry.file_size > MAX_DATA_SIZE_TO_READ_AT_ONCE:
-      raise Exception("Tried to read a very large file all at once")
-    with open(self.iso_path, "rb") as iso_file:
-      data = read_bytes(iso_file, file_entry.file_data_offset, file_entry.file_size)
-    data = BytesIO(data)
-    
-    return data
+    return self.get_file_entry_view(file_entry)
   
-  def read_file_raw_data(self, file_path):
+  def read_file_data(self, file_path):
     file_path = file_path.lower()
     if file_path not in self.files_by_path_lowercase:
       raise Exception("Could not find file: " + file_path)
     
     file_entry = self.files_by_path_lowercase[file_path]
-    with open(self.iso_path, "rb") as iso_file:
-      data = read_bytes(iso_file, file_entry.file_data_offset, file_entry.file_size)
+    if file_entry.file_size > MAX_DATA_SIZE_TO_READ_AT_ONCE:
+      raise Exception("Tried to read a very large file all at once")
+    data = BytesIO(self.get_file_entry_view(file_entry))
     
     return data
   
+  def read_file_raw_data(self, file_path):
+    return bytes(self.get_file_view(file_path))
+  
   def get_dir_file_entry(self, dir_path):
     dir_path = dir_path.lower()
     if dir_path not in self.dirs_by_path_lowercase:
@@ -204,29 +277,53 @@ class GCM:
           file_data.seek(0)
           f.write(file_data.read())
       else:
-        # Need to avoid reading enormous files all at once
-        size_remaining = file_entry.file_size
-        offset_in_file = 0
         with open(full_file_path, "wb") as f:
-          while size_remaining > 0:
-            size_to_read = min(size_remaining, MAX_DATA_SIZE_TO_READ_AT_ONCE)
-            
-            with open(self.iso_path, "rb") as iso_file:
-              data = read_bytes(iso_file, file_entry.file_data_offset + offset_in_file, size_to_read)
-            f.write(data)
-            
-            size_remaining -= size_to_read
-            offset_in_file += size_to_read
+          self.write_file_entry_data(f, file_entry)
+  
+  def write_file_entry_data(self, f, file_entry):
+    # Writes the data of a file in the input ISO to f.
+    # If f is a regular file the data is copied by the kernel without passing through Python. Whatever can't be
+    # copied that way is written in chunks so that very large files are never in memory all at once.
+    copied = 0
+    try:
+      out_fd = f.fileno()
+    except (AttributeError, OSError, UnsupportedOperation):
+      out_fd = None
+    
+    self.open_iso()
+    if out_fd is not None and self.disc.fileno() is not None:
+      f.flush()
+      out_offset = f.tell()
+      copied = kernel_copy(self.disc.fileno(), file_entry.file_data_offset, out_fd, out_offset, file_entry.file_size)
+      f.seek(out_offset + copied)
+    
+    for offset, data in self.iter_file_entry_chunks(file_entry, copied):
+      f.write(data)
   
-  def export_disc_to_iso_with_changed_files(self, output_file_path):
+  def export_disc_to_iso_with_changed_files(self, output_file_path, workers=None, skip_zero_blocks=False, preallocate=False,
+                                            compute_hashes=False, manifest_path=None, hash_cache_path=None):
+    # Padding is never written, it's left as holes in the output ISO which read as zeroes. With skip_zero_blocks,
+    # blocks of file data that are all zero are left as holes as well, so the ISO takes up less space on filesystems
+    # that support sparse files. preallocate reserves the space for the whole ISO up front instead, which avoids
+    # fragmentation but makes the ISO take up its full size.
+    # With compute_hashes or manifest_path, the CRC32, MD5 and SHA-1 of the ISO are computed from the data as it's
+    # written and returned, and a manifest with the hashes of every file is written to manifest_path.
+    # Hashes of unchanged files are kept in the file at hash_cache_path, so they only need to be computed once per input ISO.
     if os.path.realpath(self.iso_path) == os.path.realpath(output_file_path):
       raise Exception("Input ISO path and output ISO path are the same. Aborting.")
     
-    self.output_iso = open(output_file_path, "wb")
+    compute_hashes = compute_hashes or manifest_path is not None
+    cached_file_hashes = None
+    if compute_hashes and hash_cache_path is not None:
+      cached_file_hashes = self.read_hash_cache(hash_cache_path)
+    
+    self.output_iso = open(output_file_path, "w+b")
     try:
       self.export_system_data_to_iso()
-      self.export_filesystem_to_iso()
-      self.align_output_iso_to_nearest(2048*16)
+      hashes = self.export_filesystem_to_iso(workers, skip_zero_blocks, preallocate, compute_hashes, cached_file_hashes)
+      self.align_output_iso_to_nearest(ISO_SIZE_ALIGNMENT)
+      # Extend the ISO over any padding at its end
+      self.output_iso.truncate()
     except:
       self.output_iso.close()
       os.remove(output_file_path)
@@ -234,6 +331,117 @@ class GCM:
     finally:
       self.output_iso.close()
       self.output_iso = None
+    
+    if not compute_hashes:
+      return None
+    
+    iso_hashes, file_hashes = hashes
+    if hash_cache_path is not None:
+      self.write_hash_cache(hash_cache_path, cached_file_hashes)
+    if manifest_path is not None:
+      with open(manifest_path, "w") as f:
+        json.dump({"iso": iso_hashes, "files": file_hashes}, f, indent=2)
+    
+    return iso_hashes
+  
+  def export_disc_to_gcz_with_changed_files(self, output_file_path, block_size=GCZ_DEFAULT_BLOCK_SIZE, workers=None, compression_level=9):
+    # Writes the same disc as export_disc_to_iso_with_changed_files, compressed to a GCZ file.
+    # The blocks are compressed on a pool of threads and written in order. Blocks that are all zero, like most padding,
+    # aren't compressed again every time.
+    if os.path.realpath(self.iso_path) == os.path.realpath(output_file_path):
+      raise Exception("Input ISO path and output ISO path are the same. Aborting.")
+    
+    image = self.get_output_disc_image()
+    num_blocks = (image.size + block_size - 1) // block_size
+    data_offset = GCZ_HEADER_SIZE + num_blocks*8 + num_blocks*4
+    
+    if workers is None:
+      workers = os.cpu_count() or 1
+    zero_block = zlib.compress(bytes(block_size), compression_level)
+    
+    block_offsets = []
+    block_hashes = []
+    compressed_size = 0
+    
+    try:
+      with open(output_file_path, "wb") as f:
+        # The header and block tables are written once all blocks are compressed
+        f.seek(data_offset)
+        
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+          # Only a few batches of blocks are compressed ahead of the one being written, so memory use stays low
+          pending = deque()
+          batch_starts = iter(range(0, num_blocks, GCZ_BLOCKS_PER_JOB))
+          
+          while True:
+            for batch_start in batch_starts:
+              batch_end = min(batch_start + GCZ_BLOCKS_PER_JOB, num_blocks)
+              pending.append(executor.submit(compress_gcz_blocks, image, batch_start, batch_end, block_size,
+                                             compression_level, zero_block))
+              if len(pending) >= workers*2:
+                break
+            if not pending:
+              break
+            
+            for stored_data, is_compressed in pending.popleft().result():
+              block_offset = compressed_size
+              if not is_compressed:
+                block_offset |= GCZ_UNCOMPRESSED_BLOCK_FLAG
+              block_offsets.append(block_offset)
+              block_hashes.append(zlib.adler32(stored_data))
+              
+              f.write(stored_data)
+              compressed_size += len(stored_data)
+        
+        f.seek(0)
+        f.write(pack("<IIQQII", GCZ_MAGIC, 0, compressed_size, image.size, block_size, num_blocks)) # Sub type 0 is GameCube
+        f.write(pack("<%dQ" % num_blocks, *block_offsets))
+        f.write(pack("<%dI" % num_blocks, *block_hashes))
+    except:
+      os.remove(output_file_path)
+      raise
+  
+  def get_output_disc_image(self):
+    # Lays out the output ISO like export_disc_to_iso_with_changed_files does, without writing it.
+    # Returns a DiscImage of the data the ISO would be made of.
+    self.output_iso = BytesIO()
+    try:
+      self.export_system_data_to_iso()
+      system_data = self.output_iso.getvalue()[:self.fst_offset]
+    finally:
+      self.output_iso = None
+    
+    layout, end_offset = self.plan_filesystem_layout(self.fst_offset + self.fst_size)
+    image = DiscImage(pad_offset_to_nearest(pad_offset_to_nearest(end_offset, 4), ISO_SIZE_ALIGNMENT))
+    image.add(0, system_data)
+    image.add(self.fst_offset, bytes(self.fst_data))
+    for file_entry, offset, file_size in layout:
+      if file_entry.file_path in self.changed_files:
+        image.add(offset, read_all_bytes(self.changed_files[file_entry.file_path]))
+      else:
+        image.add(offset, self.get_file_entry_range(file_entry))
+    
+    return image
+  
+  def get_hash_cache_id(self):
+    # Identifies the input ISO that cached hashes belong to
+    stat = os.stat(self.iso_path)
+    return "{0}:{1}".format(stat.st_size, stat.st_mtime_ns)
+  
+  def read_hash_cache(self, hash_cache_path):
+    try:
+      with open(hash_cache_path, "r") as f:
+        cache = json.load(f)
+    except (OSError, ValueError):
+      return {}
+    
+    if cache.get("iso") != self.get_hash_cache_id():
+      return {}
+    return cache.get("files", {})
+  
+  def write_hash_cache(self, hash_cache_path, cached_file_hashes):
+    with open(hash_cache_path, "w") as f:
+      json.dump({"iso": self.get_hash_cache_id(), "files": cached_file_hashes}, f)
   
   def get_changed_file_data(self, file_path):
     if file_path in self.changed_files:
@@ -276,7 +484,8 @@ class GCM:
       del self.changed_files[file_entry.file_path]
   
   def pad_output_iso_by(self, amount):
-    self.output_iso.write(b"\0"*amount)
+    # Padding is skipped instead of written, see export_disc_to_iso_with_changed_files
+    self.output_iso.seek(amount, 1)
   
   def align_output_iso_to_nearest(self, size):
     current_offset = self.output_iso.tell()
@@ -322,35 +531,40 @@ class GCM:
     self.align_output_iso_to_nearest(0x100)
     
     
-    # Write the FST and FNT to the ISO.
-    # File offsets and file sizes are left at 0, they will be filled in as the actual file data is written to the ISO.
+    # Build the FST and FNT for the ISO.
+    # File offsets and file sizes are left at 0, they are filled in as the actual file data is written to the ISO,
+    # and the FST is written to the ISO in one go once all file data has been written.
     self.recalculate_file_entry_indexes()
     self.fst_offset = self.output_iso.tell()
     write_u32(self.output_iso, 0x424, self.fst_offset)
     self.fnt_offset = self.fst_offset + len(self.file_entries)*0xC
     
-    file_entry_offset = self.fst_offset
-    next_name_offset = self.fnt_offset
+    encoded_names = []
+    next_name_offset = 0
     for file_index, file_entry in enumerate(self.file_entries):
-      file_entry.name_offset = next_name_offset - self.fnt_offset
-      
+      file_entry.name_offset = next_name_offset
+      if file_index != 0: # Root doesn't have a name
+        encoded_name = file_entry.name.encode("shift_jis")
+        encoded_names.append(encoded_name)
+        next_name_offset += len(encoded_name)+1
+    encoded_names.append(b"")
+    fnt = b"\0".join(encoded_names)
+    
+    self.fst_data = bytearray(len(self.file_entries)*0xC)
+    for file_entry in self.file_entries:
       is_dir_and_name_offset = 0
       if file_entry.is_dir:
         is_dir_and_name_offset |= 0x01000000
       is_dir_and_name_offset |= (file_entry.name_offset & 0x00FFFFFF)
-      write_u32(self.output_iso, file_entry_offset, is_dir_and_name_offset)
       
       if file_entry.is_dir:
-        write_u32(self.output_iso, file_entry_offset+4, file_entry.parent_fst_index)
-        write_u32(self.output_iso, file_entry_offset+8, file_entry.next_fst_index)
-      
-      file_entry_offset += 0xC
-      
-      if file_index != 0: # Root doesn't have a name
-        write_str_with_null_byte(self.output_iso, next_name_offset, file_entry.name)
-        next_name_offset += len(file_entry.name)+1
+        pack_into(">III", self.fst_data, file_entry.file_index*0xC, is_dir_and_name_offset,
+                  file_entry.parent_fst_index, file_entry.next_fst_index)
+      else:
+        pack_into(">I", self.fst_data, file_entry.file_index*0xC, is_dir_and_name_offset)
+    self.fst_data += fnt
     
-    self.fst_size = self.output_iso.tell() - self.fst_offset
+    self.fst_size = len(self.fst_data)
     write_u32(self.output_iso, 0x428, self.fst_size)
     write_u32(self.output_iso, 0x42C, self.fst_size) # Seems to be a duplicate size field that must also be updated
     self.output_iso.seek(self.fst_offset + self.fst_size)
@@ -373,12 +587,9 @@ class GCM:
       
       curr_file_entry.next_fst_index = len(self.file_entries)
   
-  def export_filesystem_to_iso(self):
-    # Updates file offsets and sizes in the FST, and writes the files to the ISO.
-    
-    file_data_start_offset = self.fst_offset + self.fst_size
-    self.output_iso.seek(file_data_start_offset)
-    self.align_output_iso_to_nearest(4)
+  def plan_filesystem_layout(self, file_data_start_offset):
+    # Computes the offset of every file in the output ISO and fills the offsets and sizes into the FST.
+    # Returns a list of (file entry, offset, size) in the order the files are written and the offset at which the last file ends.
     
     # Instead of writing the file data in the order of file entries, write them in the order they were written in the vanilla ISO.
     # This increases the speed the game loads file for some unknown reason.
@@ -388,73 +599,361 @@ class GCM:
     ]
     file_entries_by_data_order.sort(key=lambda fe: fe.file_data_offset)
     
+    layout = []
+    offset = pad_offset_to_nearest(file_data_start_offset, 4)
+    end_offset = offset
     for file_entry in file_entries_by_data_order:
-      current_file_start_offset = self.output_iso.tell()
-      
-      if file_entry.file_path in self.changed_files:
-        file_data = self.changed_files[file_entry.file_path]
-        file_data.seek(0)
-        self.output_iso.write(file_data.read())
-      else:
-        # Unchanged file.
-        # Most of the game's data falls into this category, so we read the data directly instead of calling read_file_data which would create a BytesIO object, which would add unnecessary performance overhead.
-        # Also, we need to read very large files in chunks to avoid running out of memory.
-        size_remaining = file_entry.file_size
-        offset_in_file = 0
-        while size_remaining > 0:
-          size_to_read = min(size_remaining, MAX_DATA_SIZE_TO_READ_AT_ONCE)
-          
-          with open(self.iso_path, "rb") as iso_file:
-            data = read_bytes(iso_file, file_entry.file_data_offset + offset_in_file, size_to_read)
-          self.output_iso.write(data)
-          
-          size_remaining -= size_to_read
-          offset_in_file += size_to_read
-      
-      file_entry_offset = self.fst_offset + file_entry.file_index*0xC
-      write_u32(self.output_iso, file_entry_offset+4, current_file_start_offset)
       if file_entry.file_path in self.changed_files:
         file_size = data_len(self.changed_files[file_entry.file_path])
       else:
         file_size = file_entry.file_size
-      write_u32(self.output_iso, file_entry_offset+8, file_size)
+      pack_into(">II", self.fst_data, file_entry.file_index*0xC+4, offset, file_size)
       
       # Note: The file_data_offset and file_size fields of the FileEntry must not be updated, they refer only to the offset and size of the file data in the input ISO, not this output ISO.
       
-      self.output_iso.seek(current_file_start_offset + file_size)
+      layout.append((file_entry, offset, file_size))
+      end_offset = offset + file_size
+      offset = pad_offset_to_nearest(end_offset, 4)
+    
+    return layout, end_offset
+  
+  def export_filesystem_to_iso(self, workers=None, skip_zero_blocks=False, preallocate=False, compute_hashes=False, cached_file_hashes=None):
+    # Updates file offsets and sizes in the FST, and writes the files to the ISO.
+    # All offsets are known up front, so the files are written with positioned writes on a pool of threads where
+    # the OS supports them. The gaps between files are left as holes, which read as zeroes.
+    # If compute_hashes is set, the hashes of the ISO and its files are returned, see hash_output_iso.
+    layout, end_offset = self.plan_filesystem_layout(self.fst_offset + self.fst_size)
+    
+    iso_size = pad_offset_to_nearest(pad_offset_to_nearest(end_offset, 4), ISO_SIZE_ALIGNMENT)
+    self.output_iso.flush()
+    self.output_iso.truncate(iso_size)
+    if preallocate and hasattr(os, "posix_fallocate"):
+      try:
+        os.posix_fallocate(self.output_iso.fileno(), 0, iso_size)
+      except OSError:
+        pass # Not supported by the filesystem
+    
+    if compute_hashes:
+      self.output_iso.seek(0)
+      system_data = self.output_iso.read(self.fst_offset)
+    
+    # Changed files are read by the job that writes them, so only the files being written are in memory at once.
+    # The hashes are computed from a second read of them.
+    hashes = None
+    if hasattr(os, "pwrite") and workers != 1:
+      self.output_iso.flush()
+      out_fd = self.output_iso.fileno()
+      
+      with ThreadPoolExecutor(max_workers=workers) as executor:
+        # The hashes are computed while the files are written
+        if compute_hashes:
+          hash_job = executor.submit(self.hash_output_iso, system_data, layout, iso_size, cached_file_hashes)
+        
+        jobs = []
+        for file_entry, offset, file_size in layout:
+          if file_entry.file_path in self.changed_files:
+            jobs.append(executor.submit(self.pwrite_changed_file_data, out_fd, file_entry.file_path, offset, skip_zero_blocks))
+          else:
+            jobs.append(executor.submit(self.pwrite_file_entry_data, out_fd, file_entry, offset, skip_zero_blocks))
+        
+        for job in jobs:
+          job.result()
+        if compute_hashes:
+          hashes = hash_job.result()
+    else:
+      for file_entry, offset, file_size in layout:
+        if file_entry.file_path in self.changed_files:
+          self.write_data_to_output_iso(self.read_changed_file(file_entry.file_path), offset, skip_zero_blocks)
+        elif skip_zero_blocks:
+          for offset_in_file, data in self.iter_file_entry_chunks(file_entry):
+            self.write_data_to_output_iso(data, offset + offset_in_file, skip_zero_blocks)
+        else:
+          # Unchanged file.
+          # Most of the game's data falls into this category, so we write the data directly from the mapped input ISO instead of calling read_file_data which would create a BytesIO object, which would add unnecessary performance overhead.
+          self.output_iso.seek(offset)
+          self.write_file_entry_data(self.output_iso, file_entry)
+      
+      if compute_hashes:
+        hashes = self.hash_output_iso(system_data, layout, iso_size, cached_file_hashes)
+    
+    # Write the FST now that it has all file offsets and sizes
+    self.output_iso.seek(self.fst_offset)
+    self.output_iso.write(self.fst_data)
+    
+    self.output_iso.seek(end_offset)
+    self.align_output_iso_to_nearest(4)
+    
+    return hashes
+  
+  def read_changed_file(self, file_path):
+    with self.changed_files_lock:
+      return read_all_bytes(self.changed_files[file_path])
+  
+  def pwrite_changed_file_data(self, out_fd, file_path, out_offset, skip_zero_blocks=False):
+    pwrite_data(out_fd, self.read_changed_file(file_path), out_offset, skip_zero_blocks)
+  
+  def hash_output_iso(self, system_data, layout, iso_size, cached_file_hashes=None):
+    # Computes the hashes of the output ISO from the data it's written from, instead of reading the written ISO back.
+    # system_data is the data before the FST. Returns the hashes of the ISO and a dict of the offset, size and hashes of every file by path.
+    # Hashes of unchanged files are looked up in cached_file_hashes if it's set, and newly computed ones are added to it.
+    iso_hash = MultiHash()
+    iso_hash.update(system_data)
+    iso_hash.update(self.fst_data)
+    position = self.fst_offset + len(self.fst_data)
+    
+    file_hashes = {}
+    for file_entry, offset, file_size in layout:
+      iso_hash.update_zeroes(offset - position)
+      
+      changed = file_entry.file_path in self.changed_files
+      cached = None
+      if changed:
+        data = memoryview(self.read_changed_file(file_entry.file_path))
+        chunks = ((chunk_start, data[chunk_start:chunk_start+HASH_CHUNK_SIZE]) for chunk_start in range(0, len(data), HASH_CHUNK_SIZE))
+      else:
+        chunks = self.iter_file_entry_chunks(file_entry, chunk_size=HASH_CHUNK_SIZE)
+        cache_key = "{0:x}:{1:x}".format(file_entry.file_data_offset, file_entry.file_size)
+        if cached_file_hashes is not None:
+          cached = cached_file_hashes.get(cache_key)
+      
+      file_hash = None
+      if cached is None:
+        file_hash = MultiHash()
       
-      self.align_output_iso_to_nearest(4)
+      for chunk_start, chunk in chunks:
+        iso_hash.update(chunk)
+        if file_hash is not None:
+          file_hash.update(chunk)
+      
+      if cached is None:
+        cached = file_hash.hexdigests()
+        if not changed and cached_file_hashes is not None:
+          cached_file_hashes[cache_key] = cached
+      
+      file_hashes[file_entry.file_path] = dict(offset=offset, size=file_size, changed=changed, **cached)
+      position = offset + file_size
+    
+    iso_hash.update_zeroes(iso_size - position)
+    
+    iso_hashes = iso_hash.hexdigests()
+    iso_hashes["size"] = iso_size
+    return iso_hashes, file_hashes
+  
+  def write_data_to_output_iso(self, data, offset, skip_zero_blocks=False):
+    if skip_zero_blocks:
+      runs = find_nonzero_runs(data)
+    else:
+      runs = [(0, len(data))]
+    
+    data = memoryview(data)
+    for start, end in runs:
+      self.output_iso.seek(offset + start)
+      for chunk_start in range(start, end, MAX_DATA_SIZE_TO_READ_AT_ONCE):
+        self.output_iso.write(data[chunk_start:min(end, chunk_start+MAX_DATA_SIZE_TO_READ_AT_ONCE)])
+  
+  def pwrite_file_entry_data(self, out_fd, file_entry, out_offset, skip_zero_blocks=False):
+    # Like write_file_entry_data, but writes at out_offset without using the file position, so it can be used from several threads at once.
+    # Zero blocks can only be skipped if the data is looked at, so it isn't copied in the kernel then.
+    copied = 0
+    if not skip_zero_blocks and self.disc.fileno() is not None:
+      copied = kernel_copy(self.disc.fileno(), file_entry.file_data_offset, out_fd, out_offset, file_entry.file_size,
+                           use_sendfile=False)
+    
+    for offset, data in self.iter_file_entry_chunks(file_entry, copied):
+      pwrite_data(out_fd, data, out_offset + offset, skip_zero_blocks)
+
+class DiscImage:
+  # The data of a disc image made of pieces of data at offsets in it, with zeroes in between.
+  def __init__(self, size):
+    self.size = size
+    self.offsets = []
+    self.pieces = []
+  
+  def add(self, offset, data):
+    # Pieces must be added in order of their offsets and must not overlap
+    self.offsets.append(offset)
+    self.pieces.append(data)
+  
+  def read(self, offset, size):
+    result = bytearray(size)
+    end = offset + size
+    
+    i = max(0, bisect_right(self.offsets, offset) - 1)
+    while i < len(self.offsets) and self.offsets[i] < end:
+      piece_offset = self.offsets[i]
+      piece = self.pieces[i]
+      start_in_result = max(piece_offset, offset)
+      end_in_result = min(piece_offset + len(piece), end)
+      if start_in_result < end_in_result:
+        result[start_in_result-offset:end_in_result-offset] = piece[start_in_result-piece_offset:end_in_result-piece_offset]
+      i += 1
+    
+    return result
+
+def compress_gcz_blocks(image, first_block, end_block, block_size, compression_level, zero_block):
+  # Returns the data to store for every block and whether it's compressed.
+  # Blocks that don't get smaller from compression are stored uncompressed.
+  empty_block = bytes(block_size)
+  blocks = []
+  for block_index in range(first_block, end_block):
+    data = image.read(block_index*block_size, block_size)
+    if data == empty_block:
+      blocks.append((zero_block, True))
+      continue
+    
+    compressed = zlib.compress(data, compression_level)
+    if len(compressed) < block_size:
+      blocks.append((compressed, True))
+    else:
+      blocks.append((bytes(data), False))
+  
+  return blocks
+
+class MultiHash:
+  # Computes the CRC32, MD5 and SHA-1 of data at the same time.
+  __slots__ = ("crc32", "md5", "sha1")
+  
+  def __init__(self):
+    self.crc32 = 0
+    self.md5 = hashlib.md5()
+    self.sha1 = hashlib.sha1()
+  
+  def update(self, data):
+    self.crc32 = zlib.crc32(data, self.crc32)
+    self.md5.update(data)
+    self.sha1.update(data)
+  
+  def update_zeroes(self, size):
+    zeroes = bytes(min(size, HASH_CHUNK_SIZE))
+    while size > 0:
+      self.update(zeroes[:size])
+      size -= len(zeroes)
+  
+  def hexdigests(self):
+    return {
+      "crc32": "%08x" % self.crc32,
+      "md5": self.md5.hexdigest(),
+      "sha1": self.sha1.hexdigest(),
+    }
+
+def find_nonzero_runs(data, block_size=ZERO_BLOCK_SIZE):
+  # Returns the (start, end) ranges of data that are left when all blocks of block_size bytes that are all zero are removed.
+  data = memoryview(data)
+  zero_block = bytes(block_size)
+  runs = []
+  run_start = None
+  for block_start in range(0, len(data), block_size):
+    block = bytes(data[block_start:block_start+block_size])
+    if block == zero_block[:len(block)]:
+      if run_start is not None:
+        runs.append((run_start, block_start))
+        run_start = None
+    elif run_start is None:
+      run_start = block_start
+  
+  if run_start is not None:
+    runs.append((run_start, len(data)))
+  
+  return runs
+
+def pwrite_data(fd, data, offset, skip_zero_blocks=False):
+  # Writes data at offset in fd. With skip_zero_blocks, blocks that are all zero are left as holes.
+  if skip_zero_blocks:
+    runs = find_nonzero_runs(data)
+  else:
+    runs = [(0, len(data))]
+  
+  data = memoryview(data)
+  for start, end in runs:
+    for chunk_start in range(start, end, MAX_DATA_SIZE_TO_READ_AT_ONCE):
+      pwrite_all(fd, data[chunk_start:min(end, chunk_start+MAX_DATA_SIZE_TO_READ_AT_ONCE)], offset + chunk_start)
+
+def pwrite_all(fd, data, offset):
+  # os.pwrite can write less than all of the data
+  data = memoryview(data)
+  while len(data) > 0:
+    written = os.pwrite(fd, data, offset)
+    data = data[written:]
+    offset += written
+
+def kernel_copy(in_fd, in_offset, out_fd, out_offset, size, use_sendfile=True):
+  # Copies data between two files in the kernel with copy_file_range, which also lets filesystems that support it
+  # share the data between both files instead of copying it, or with sendfile if that isn't supported.
+  # Returns how many bytes were copied, which is less than size if neither works for these files.
+  # sendfile changes the position of out_fd, so it isn't used if use_sendfile is False.
+  copied = 0
+  
+  if hasattr(os, "copy_file_range"):
+    try:
+      while copied < size:
+        result = os.copy_file_range(in_fd, out_fd, size - copied, in_offset + copied, out_offset + copied)
+        if result == 0:
+          break
+        copied += result
+    except OSError:
+      pass
+    if copied == size:
+      return copied
+  
+  if use_sendfile and hasattr(os, "sendfile"):
+    try:
+      os.lseek(out_fd, out_offset + copied, os.SEEK_SET)
+      while copied < size:
+        result = os.sendfile(out_fd, in_fd, in_offset + copied, size - copied)
+        if result == 0:
+          break
+        copied += result
+    except OSError:
+      pass
+  
+  return copied
+
+def split_name_table(fnt):
+  # Returns a dict of every name in the FNT by its offset.
+  # Names that can't be decoded, like padding after the last name, are left out. If a file entry uses one of them
+  # after all, it's read on its own and fails only then.
+  names = {}
+  offset = 0
+  for name in fnt.split(b"\0"):
+    try:
+      names[offset] = name.decode("shift_jis")
+    except UnicodeDecodeError:
+      pass
+    offset += len(name)+1
+  
+  return names
 
 class FileEntry:
+  __slots__ = (
+    "file_index", "is_dir", "is_system_file", "name_offset", "name", "file_path", "dir_path",
+    "parent", "children", "parent_fst_index", "next_fst_index", "file_data_offset", "file_size",
+  )
+  
   def __init__(self):
     self.file_index = None
     
     self.is_dir = False
     self.is_system_file = False
+    self.parent = None
   
-  def read(self, file_index, iso_file, file_entry_offset, fnt_offset):
-    self.file_index = file_index
-    
-    is_dir_and_name_offset = read_u32(iso_file, file_entry_offset)
-    file_data_offset_or_parent_fst_index = read_u32(iso_file, file_entry_offset+4)
-    file_size_or_next_fst_index = read_u32(iso_file, file_entry_offset+8)
-    
-    self.is_dir = ((is_dir_and_name_offset & 0xFF000000) != 0)
-    self.name_offset = (is_dir_and_name_offset & 0x00FFFFFF)
-    self.name = ""
-    if self.is_dir:
-      self.parent_fst_index = file_data_offset_or_parent_fst_index
-      self.next_fst_index = file_size_or_next_fst_index
-      self.children = []
+  @classmethod
+  def from_record(cls, file_index, is_dir_and_name_offset, file_data_offset_or_parent_fst_index, file_size_or_next_fst_index, name):
+    # Creates a file entry from the unpacked values of its FST entry.
+    file_entry = cls()
+    file_entry.file_index = file_index
+    
+    file_entry.is_dir = ((is_dir_and_name_offset & 0xFF000000) != 0)
+    file_entry.name_offset = (is_dir_and_name_offset & 0x00FFFFFF)
+    file_entry.name = name
+    if file_entry.is_dir:
+      file_entry.parent_fst_index = file_data_offset_or_parent_fst_index
+      file_entry.next_fst_index = file_size_or_next_fst_index
+      file_entry.children = []
     else:
-      self.file_data_offset = file_data_offset_or_parent_fst_index
-      self.file_size = file_size_or_next_fst_index
-    self.parent = None
+      file_entry.file_data_offset = file_data_offset_or_parent_fst_index
+      file_entry.file_size = file_size_or_next_fst_index
     
-    if file_index == 0:
-      self.name = "" # Root
-    else:
-      self.name = read_str_until_null_character(iso_file, fnt_offset + self.name_offset)
+    return file_entry
 
 class SystemFile:
   def __init__(self, file_data_offset, file_size, name):
@@ -1,13 +1,19 @@
 import os 
+import sys
+import glob
 import time
 import logging
 import tempfile
 import subprocess 
 
+from collections import namedtuple
 from io import BytesIO
-from itertools import chain
-from struct import pack, unpack
-from .yaz0 import decompress, compress_fast, read_uint32, read_uint16
+from itertools import chain, repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from bisect import bisect_right
+from struct import pack, unpack, iter_unpack
+from .compression_cache import CompressionCache, DEFAULT_MAX_SIZE
+from .yaz0 import decompress_bytes, compress_bytes, compress_parallel, Yaz0Reader, probe, DEFAULT_LEVEL
 
 log = logging.getLogger(__name__)
 
@@ -29,17 +35,28 @@ def write_pad32(f):
 
 
 class CompressionSetting(object):
-    def __init__(self, yaz0_fast=False, wszst=False, compression_level="9"):
+    def __init__(self, yaz0_fast=False, wszst=False, compression_level="9", yaz0=False, yaz0_level=DEFAULT_LEVEL,
+                 workers=None, cache=None):
         self.yaz0_fast = yaz0_fast 
         self.wszst = wszst 
         self.compression_level = compression_level
+        self.yaz0 = yaz0
+        self.yaz0_level = yaz0_level
+        self.workers = workers # Number of processes for yaz0 compression, None uses all cores
+        self.cache = cache # CompressionCache checked before compressing, None disables caching
     
     def run_wszst(self, file):
         if not self.wszst:
             raise RuntimeError("Wszst is not used")
+        filedata = file.getvalue()
+        cache_setting = "wszst-{0}".format(self.compression_level)
+        if self.cache is not None:
+            cached_data = self.cache.get(filedata, cache_setting)
+            if cached_data is not None:
+                return cached_data
+
         handle, abspath = tempfile.mkstemp()
         os.close(handle)
-        filedata = file.getvalue()
         with open(abspath, "wb") as f:
             #log.info("writing to", abspath)
             f.write(filedata)
@@ -60,11 +77,48 @@ class CompressionSetting(object):
         os.remove(abspath)
         os.remove(outpath)
         
-        if len(filedata) >= len(compressed_data):
-            return compressed_data 
-        else:
+        if len(filedata) < len(compressed_data):
             log.warning("Compressed data bigger than original, using uncompressed data")
-            return filedata 
+            compressed_data = filedata
+
+        if self.cache is not None:
+            self.cache.put(filedata, cache_setting, compressed_data)
+
+        return compressed_data 
+
+    def compress_members(self, files):
+        # Yaz0 compresses the data of every file concurrently and returns the results in the same order.
+        # Files are compressed with wszst if it is used, otherwise with the built-in compressor
+        # at yaz0_level, or the fastest level if yaz0_fast is set.
+        if len(files) == 0:
+            return []
+
+        if self.wszst:
+            # wszst runs in its own process already
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                return list(executor.map(self.run_wszst, files))
+
+        level = 1 if self.yaz0_fast else self.yaz0_level
+        if self.workers == 1 or len(files) == 1:
+            return [compress_bytes(file.getvalue(), level, self.cache) for file in files]
+
+        # A file's data is only read when it's submitted, and only a couple of files per worker are submitted
+        # ahead, so the uncompressed data of all files is never in memory at once.
+        workers = self.workers or os.cpu_count() or 1
+        results = [None]*len(files)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            jobs = {}
+            for i, file in enumerate(files):
+                if len(jobs) >= 2*workers:
+                    done, not_done = wait(jobs, return_when=FIRST_COMPLETED)
+                    for job in done:
+                        results[jobs.pop(job)] = job.result()
+                jobs[executor.submit(compress_bytes, file.getvalue(), level, self.cache)] = i
+
+            for job, i in jobs.items():
+                results[i] = job.result()
+
+        return results
 
 
 
@@ -191,26 +245,43 @@ class StringTable(object):
     def write_to(self, f):
         f.write(self._strings.getvalue())
 
-def stringtable_get_name(f, stringtable_offset, offset):
-    current = f.tell()
-    f.seek(stringtable_offset+offset)
+def unpack_entry_flags_and_offsets(entries):
+    # Yields the flags and data offset (or node index for directories) of every 20-byte file entry
+    for fileid, hashcode, flags, padbyte, nameoffset, filedataoffset, datasize, padding in iter_unpack(">HHBBHIII", entries):
+        yield flags, filedataoffset
 
-    stringlen = 0
-    while f.read(1) != b"\x00":
-        stringlen += 1
 
-    f.seek(stringtable_offset+offset)
+class StringTableNames(dict):
+    # Maps offsets in a string table to the names at those offsets.
+    # The string table is split into names once, offsets that point into the middle of a name
+    # (which is allowed for names that end the same way) are decoded when they are first used.
+    def __init__(self, data):
+        super().__init__()
+        self._data = data
+
+        offset = 0
+        for name in data.split(b"\x00"):
+            try:
+                self[offset] = name.decode("shift-jis")
+            except UnicodeDecodeError:
+                pass # Raise the error only if the name is actually used
+            offset += len(name) + 1
+
+    def __missing__(self, offset):
+        end = self._data.find(b"\x00", offset)
+        if end == -1:
+            end = len(self._data)
+        filename = self._data[offset:end]
+        try:
+            decodedfilename = filename.decode("shift-jis")
+        except:
+            log.error(f"filename: {filename}")
+            log.error("failed")
+            raise
 
-    filename = f.read(stringlen)
-    try:
-        decodedfilename = filename.decode("shift-jis")
-    except:
-        log.error(f"filename: {filename}")
-        log.error("failed")
-        raise
-    f.seek(current)
+        self[offset] = decodedfilename
+        return decodedfilename
 
-    return decodedfilename
 
 def split_path(path): # Splits path at first backslash encountered
     for i, char in enumerate(path):
@@ -222,14 +293,132 @@ def split_path(path): # Splits path at first backslash encountered
 
     return path, None
 
+ArchiveInfo = namedtuple("ArchiveInfo", ["yaz0", "size", "node_count", "entry_count", "file_count",
+                                         "data_offset", "data_size", "root_name"])
+
+
+def probe_archive(f):
+    # Reads only the 0x40-byte RARC header, the root node and the root name instead of the whole archive.
+    # If the archive is Yaz0-compressed, only the start of it is decompressed.
+    # The position of f is left unchanged.
+    start = f.tell()
+    yaz0_header = probe(f)
+
+    if yaz0_header is not None:
+        data = Yaz0Reader(f)
+        base = 0
+    else:
+        data = f
+        base = start
+
+    try:
+        data.seek(base)
+        header = data.read(0x50) # Header and root node
+        if header[:4] != b"RARC":
+            raise RuntimeError("Unknown file header: {} should be Yaz0 or RARC".format(header[:4]))
+
+        size, data_offset, data_size = unpack(">I4xII", header[4:20])
+        node_count, entry_count, stringtable_offset = unpack(">I4xI8xI", header[0x20:0x38])
+        root_nameoffset = unpack(">I", header[0x44:0x48])[0]
+
+        data.seek(base + stringtable_offset + 0x20 + root_nameoffset)
+        root_name = data.read(0x100).split(b"\x00", 1)[0].decode("shift-jis")
+    finally:
+        f.seek(start)
+
+    # Every directory node has "." and ".." entries and every directory except the root has an entry
+    # in its parent, the remaining entries are files.
+    file_count = entry_count - 3*node_count + 1
+
+    return ArchiveInfo(yaz0_header is not None, size, node_count, entry_count, file_count,
+                       data_offset + 0x20, data_size, root_name)
+
+
+class EntryDict(dict):
+    # Dictionary of the files or subdirectories of a directory that tells the directory
+    # when entries are added, replaced or removed, so path indexes can be kept up to date.
+    def __init__(self, directory):
+        super().__init__()
+        self._directory = directory
+
+    def __setitem__(self, key, value):
+        # Changes below an added directory have to reach the topmost directory to keep path indexes up to date
+        if isinstance(value, Directory):
+            value.parent = self._directory
+
+        old_value = self.get(key)
+        super().__setitem__(key, value)
+        self._directory._entry_changed(key, old_value, value)
+
+    def __delitem__(self, key):
+        old_value = self[key]
+        super().__delitem__(key)
+        self._directory._entry_changed(key, old_value, None)
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super().pop(key, *default)
+
+        result = super().pop(key)
+        self._directory._entry_changed(key, result, None)
+        return result
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._directory._entry_changed(key, value, None)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        super().clear()
+        self._directory._changed()
+
+
 class Directory(object):
     def __init__(self, dirname, nodeindex=None):
-        self.files = {}
-        self.subdirs = {}
+        # Incremented on the topmost directory whenever a directory below it is changed
+        self._generation = 0
+        # Archive whose path index is updated along with changes below the topmost directory, see Archive.find
+        self._path_index = None
+        self.parent = None
+
+        self.files = EntryDict(self)
+        self.subdirs = EntryDict(self)
         self.name = dirname
         self._nodeindex = nodeindex
 
-        self.parent = None
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        self._name = name
+        top = self._changed()
+        if top._path_index is not None:
+            top._path_index._index_dir_renamed(top, self)
+
+    def _changed(self):
+        # Marks path indexes of the tree as outdated and returns the topmost directory
+        top = self
+        while top.parent is not None:
+            top = top.parent
+        top._generation += 1
+        return top
+
+    def _entry_changed(self, name, old_entry, new_entry):
+        # Called when the entry called name is added (old_entry is None), removed (new_entry is None) or replaced
+        top = self._changed()
+        if top._path_index is not None:
+            top._path_index._index_entry_changed(top, self, name, old_entry, new_entry)
 
     @classmethod
     def from_dir(cls, path, follow_symlinks=False):
@@ -246,8 +435,8 @@ class Directory(object):
                 newdir.parent = dir
 
             elif entry.is_file(follow_symlinks=follow_symlinks):
-                with open(entry.path, "rb") as f:
-                    file = File.from_file(entry.name, f)
+                # Only the path and size are recorded, the data is read from disk when the archive is written
+                file = File.from_path(entry.name, entry.path, entry.stat(follow_symlinks=follow_symlinks).st_size)
                 dir.files[entry.name] = file
 
         return dir
@@ -255,7 +444,9 @@ class Directory(object):
 
 
     @classmethod
-    def from_node(cls, f, _name, stringtable_offset, globalentryoffset, dataoffset, nodelist, currentnodeindex, parents=None):
+    def from_node(cls, f, _name, names, entries, dataoffset, nodelist, currentnodeindex, parents=None, source=None):
+        # names is the string table of the archive as StringTableNames, entries is the list
+        # of all unpacked file entries of the archive.
         log.debug("=============================")
         log.debug(f"Creating new node with index {currentnodeindex}")
         name, unknown, entrycount, entryoffset = nodelist[currentnodeindex]
@@ -264,35 +455,18 @@ class Directory(object):
 
         newdir = cls(name, currentnodeindex)
 
-        firstentry = globalentryoffset+entryoffset
         log.debug(f"Node {currentnodeindex} {name} {entrycount} {entryoffset}")
-        log.debug(f"offset {f.tell()}")
         for i in range(entrycount):
-            offset = globalentryoffset + (entryoffset+i)*20
-            f.seek(offset)
-
-            fileentry_data = f.read(20)
-
-            fileid, hashcode, flags, padbyte, nameoffset, filedataoffset, datasize, padding = unpack(">HHBBHIII", fileentry_data)
-            log.debug(f"offset {hex(firstentry+i*20)} {fileid} {flags} {nameoffset}")
-
-            name = stringtable_get_name(f, stringtable_offset, nameoffset)
-
-            log.debug(f"name {name} {fileid}")
+            fileid, hashcode, flags, padbyte, nameoffset, filedataoffset, datasize, padding = entries[entryoffset+i]
+            name = names[nameoffset]
 
             if name == "." or name == ".." or name == "":
                 continue
-            log.debug(f"{name} {nameoffset}")
+            log.debug(f"{name} {nameoffset} {fileid} {flags}")
 
             if (flags & DIRECTORY) != 0 and not (flags & FILE): #fileid == 0xFFFF: # entry is a sub directory
-                #fileentrydata = f.read(12)
-                #nodeindex, datasize, padding = unpack(">III", fileentrydata)
                 nodeindex = filedataoffset
 
-                name = stringtable_get_name(f, stringtable_offset, nameoffset)
-                log.debug(f"{name} {hashcode} {hash_name(name)}")
-
-
                 newparents = [currentnodeindex]
                 if parents is not None:
                     newparents.extend(parents)
@@ -303,7 +477,7 @@ class Directory(object):
                     log.warning(f"Skipping")
                     continue
 
-                subdir = Directory.from_node(f, name, stringtable_offset, globalentryoffset, dataoffset, nodelist, nodeindex, parents=newparents)
+                subdir = Directory.from_node(f, name, names, entries, dataoffset, nodelist, nodeindex, parents=newparents, source=source)
                 subdir.parent = newdir
 
                 newdir.subdirs[subdir.name] = subdir
@@ -314,8 +488,8 @@ class Directory(object):
                     log.info("File is compressed")
                 if flags & YAZ0:
                     log.info("File is yaz0 compressed")
-                f.seek(offset)
-                file = File.from_fileentry(f, stringtable_offset, dataoffset, fileid, hashcode, flags, nameoffset, filedataoffset, datasize)
+                file = File.from_fileentry(f, name, dataoffset, fileid, hashcode, flags, filedataoffset, datasize, source=source)
+                file._entry = (entryoffset+i, filedataoffset, datasize)
                 newdir.files[file.name] = file
 
         return newdir
@@ -334,6 +508,13 @@ class Directory(object):
             log.debug(f"yielding subdir {dirname}")
             yield from dir.walk(dirpath)
 
+    def walk_dirs(self):
+        # Yields every directory in the same order as walk
+        yield self
+
+        for dir in self.subdirs.values():
+            yield from dir.walk_dirs()
+
     def __getitem__(self, path):
         name, rest = split_path(path)
 
@@ -403,18 +584,94 @@ class Directory(object):
         
         return name
 
-class File(BytesIO):
-    def __init__(self, filename, fileid=None, hashcode=None, flags=None):
-        super().__init__()
+def _extract_file(filepath, file):
+    with open(filepath, "w+b") as f:
+        file.dump(f)
+
 
+def _extract_yaz0_file(filepath, data):
+    with open(filepath, "w+b") as f:
+        f.write(decompress_bytes(data))
+
+
+COPY_CHUNK_SIZE = 0x100000 # 1 MiB
+
+
+class SpillFile(object):
+    # File data stored in a file on disk instead of in memory.
+    __slots__ = ("path", "size", "temporary")
+
+    def __init__(self, path, size, temporary=False):
+        self.path = path
+        self.size = size
+        self.temporary = temporary # Temporary files are deleted when they aren't used anymore
+
+    @classmethod
+    def from_data(cls, data, directory=None):
+        handle, path = tempfile.mkstemp(dir=directory, suffix=".rarc_spill")
+        with os.fdopen(handle, "wb") as f:
+            f.write(data)
+        return cls(path, len(data), temporary=True)
+
+    def read(self, offset, size):
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return f.read(max(0, min(size, self.size - offset)))
+
+    def write_to(self, f, chunk_size=COPY_CHUNK_SIZE):
+        # Copies the data to f in chunks so that it never has to be in memory completely.
+        remaining = self.size
+        with open(self.path, "rb") as src:
+            while remaining > 0:
+                chunk = src.read(min(chunk_size, remaining))
+                if not chunk:
+                    raise RuntimeError("File {0} is smaller than expected, was it changed?".format(self.path))
+                f.write(chunk)
+                remaining -= len(chunk)
+
+    def __len__(self):
+        return self.size
+
+    def __del__(self):
+        if self.temporary:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class File(object):
+    # An archive member with a file-like interface. The data is stored in one of:
+    #   - a bytearray owned by the file
+    #   - a memoryview of the buffer a lazy archive was read from, only copied when the file is written to
+    #   - a SpillFile on disk, only loaded when the file is written to
+    __slots__ = ("name", "_fileid", "_hashcode", "_flags", "_filetype", "_entry", "_data", "_position")
+
+    def __init__(self, filename, fileid=None, hashcode=None, flags=None):
         self.name = filename
         self._fileid = fileid
         self._hashcode = hashcode
         self._flags = flags
-        if flags is not None:
-            self.filetype = FileListing.from_flags(flags)
-        else:
-            self.filetype = FileListing.default()
+        self._filetype = None
+        # (entry index, data offset, data size) of the file in the archive it was read from
+        self._entry = None
+
+        self._data = bytearray()
+        self._position = 0
+
+    @property
+    def filetype(self):
+        if self._filetype is None:
+            if self._flags is not None:
+                self._filetype = FileListing.from_flags(self._flags)
+            else:
+                self._filetype = FileListing.default()
+        return self._filetype
+
+    @filetype.setter
+    def filetype(self, filetype):
+        self._filetype = filetype
+
     def is_yaz0_compressed(self):
         if self._flags & COMPRESSED and not self._flags & YAZ0:
             log.warning(f"Warning, file {self.name} is compressed but not with yaz0!")
@@ -423,41 +680,180 @@ class File(BytesIO):
     @classmethod
     def from_file(cls, filename, f):
         file = cls(filename)
+        file._data = bytearray(f.read())
 
-        file.write(f.read())
-        file.seek(0)
+        return file
+
+    @classmethod
+    def from_path(cls, filename, path, size=None):
+        # The data is read from path when it is needed, the file on disk must not change until then.
+        file = cls(filename)
+        if size is None:
+            size = os.path.getsize(path)
+        file._data = SpillFile(path, size)
 
         return file
 
     @classmethod
-    def from_fileentry(cls, f, stringtable_offset, globaldataoffset, fileid, hashcode, flags, nameoffset, filedataoffset, datasize):
-        filename = stringtable_get_name(f, stringtable_offset, nameoffset)
+    def from_fileentry(cls, f, filename, globaldataoffset, fileid, hashcode, flags, filedataoffset, datasize, source=None):
         log.debug(f"-----")
         log.debug(f'"File": {len(filename)}')
         log.debug(f'"size": {datasize}')
-        log.debug(f'{hex(stringtable_offset)} {hex(nameoffset)}')
         log.debug(f'{hex(datasize)}')
 
         file = cls(filename, fileid, hashcode, flags)
 
-        f.seek(globaldataoffset+filedataoffset)
-        file.write(f.read(datasize))
-        DATA[0] += datasize
-        # Reset file position
-        file.seek(0)
+        start = globaldataoffset+filedataoffset
+        if source is not None:
+            file._data = source[start:start+datasize]
+        else:
+            f.seek(start)
+            file._data = bytearray(f.read(datasize))
+            DATA[0] += datasize
 
         return file
 
+    def _make_writable(self):
+        if isinstance(self._data, memoryview):
+            self._data = bytearray(self._data)
+        elif isinstance(self._data, SpillFile):
+            self._data = bytearray(self._data.read(0, self._data.size))
+
+    def is_lazy(self):
+        return isinstance(self._data, memoryview)
+
+    def is_spilled(self):
+        return isinstance(self._data, SpillFile)
+
+    def spill(self, directory=None):
+        # Moves the data into a temporary file on disk to free memory.
+        if not self.is_spilled():
+            self._data = SpillFile.from_data(self._data, directory)
+
+    def size(self):
+        return len(self._data)
+
+    def peek(self, size):
+        # Returns the first size bytes of the file's data, without reading the rest of a spilled file.
+        if isinstance(self._data, SpillFile):
+            return self._data.read(0, size)
+        else:
+            return bytes(self._data[:size])
+
+    def view(self):
+        # Returns the file's data without copying it if possible.
+        if isinstance(self._data, SpillFile):
+            return self._data.read(0, self._data.size)
+        else:
+            return memoryview(self._data)
+
+    # File-like interface
+
+    def read(self, size=-1):
+        end = len(self._data)
+        if size is not None and size >= 0:
+            end = min(end, self._position + size)
+        start = min(self._position, end)
+
+        if isinstance(self._data, SpillFile):
+            data = self._data.read(start, end - start)
+        else:
+            data = bytes(self._data[start:end])
+        self._position = max(self._position, end)
+
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def write(self, data):
+        self._make_writable()
+        data = memoryview(data).cast("B")
+        end = self._position + len(data)
+        if self._position > len(self._data):
+            self._data.extend(b"\x00"*(self._position - len(self._data)))
+        self._data[self._position:end] = data
+        self._position = end
+
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            position = offset
+        elif whence == 1:
+            position = self._position + offset
+        elif whence == 2:
+            position = len(self._data) + offset
+        else:
+            raise ValueError("Invalid whence ({0}, should be 0, 1 or 2)".format(whence))
+
+        if position < 0:
+            raise ValueError("Negative seek value {0}".format(position))
+        self._position = position
+
+        return position
+
+    def tell(self):
+        return self._position
+
+    def truncate(self, size=None):
+        if size is None:
+            size = self._position
+        if size < len(self._data):
+            self._make_writable()
+            del self._data[size:]
+
+        return size
+
+    def getvalue(self):
+        return bytes(self.view())
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
     def dump(self, f):
-        if self.is_yaz0_compressed:
-            decompress(self, f, suppress_error=True)
+        data = self.getvalue()
+        if self.is_yaz0_compressed and data[:4] == b"Yaz0":
+            f.write(decompress_bytes(data))
         else:
-            f.write(self.getvalue())
+            f.write(data)
 
 
 class Archive(object):
     def __init__(self):
         self.root = None
+
+        # Flat indexes of all paths in the archive, updated along with changes to the directory tree.
+        # They are only built again if the tree was changed in a way that isn't tracked.
+        self._entries_by_path = {}
+        self._entries_by_path_lowercase = {}
+        self._index_dir_paths = {}
+        self._index_case_collisions = False
+        self._index_key = None
+
+        # Buffer and layout of the archive as it was read in lazy mode, used for incremental writes
+        self._source = None
+        self._size = None
+        self._data_offset = None
+        self._file_entry_offset = None
+        self._entry_count = None
+        self._structure = None
+        # Whether the archive was read from Yaz0-compressed data, which can't be patched in place
+        self._source_yaz0 = False
         
     @classmethod
     def from_dir(cls, path, follow_symlinks=False):
@@ -469,66 +865,222 @@ class Archive(object):
 
 
     @classmethod
-    def from_file(cls, f):
+    def from_file(cls, f, lazy=False):
+        # In lazy mode, files keep a view into the archive's data instead of a copy of their own,
+        # and only copy their data when it's accessed through the file-like interface.
         newarc = cls()
         header = f.read(4)
 
         if header == b"Yaz0":
-            # Decompress first
+            newarc._source_yaz0 = True
+
+            # Decompress first. The whole archive is needed anyway, so this is faster than reading it through
+            # a Yaz0Reader, which is only worth it for reading the header, see probe_archive.
             log.info("Yaz0 header detected, decompressing...")
             start = time.time()
-            tmp = BytesIO()
-            f.seek(0)
-            decompress(f, tmp)
-            #with open("decompressed.bin", "wb") as g:
-            #    decompress(f,)
-            f = tmp
             f.seek(0)
+            f = BytesIO(decompress_bytes(f.read()))
 
             header = f.read(4)
             log.info("Finished decompression.")
             log.info(f"Time taken: {time.time() - start}")
+            if header != b"RARC":
+                raise RuntimeError("Unknown file header: {} in Yaz0-compressed data should be RARC".format(header))
 
         if header == b"RARC":
             pass
         else:
             raise RuntimeError("Unknown file header: {} should be Yaz0 or RARC".format(header))
 
-        size = read_uint32(f)
-        f.read(4) #unknown
-
-        data_offset = read_uint32(f) + 0x20
-        f.read(16) # Unknown
-        node_count = read_uint32(f)
-        f.read(8) # Unknown
-        file_entry_offset = read_uint32(f) + 0x20
-        f.read(4) # Unknown
-        stringtable_offset = read_uint32(f) + 0x20
-        f.read(8) # Unknown
-        nodes = []
+        source = None
+        if lazy:
+            f.seek(0)
+            buffer = f.read()
+            source = memoryview(buffer)
+            f = BytesIO(buffer)
+            f.seek(4)
+
+        # Read the header and every table in one go instead of one entry or name at a time
+        (size, data_offset, node_count, file_entry_offset, stringtable_size,
+         stringtable_offset) = unpack(">I4xI16xI8xIII8x", f.read(0x3C))
+        data_offset += 0x20
+        file_entry_offset += 0x20
+        stringtable_offset += 0x20
 
         log.debug(f"Archive has {node_count} total directories")
-
-                
-        
         log.debug(f"data offset {hex(data_offset)}")
-        for i in range(node_count):
-            nodetype = f.read(4)
-            nodedata = f.read(4+2+2+4)
-            nameoffset, unknown, entrycount, entryoffset = unpack(">IHHI", nodedata)
 
-            if i == 0:
-                dir_name = stringtable_get_name(f, stringtable_offset, nameoffset)
-            else:
-                dir_name = None 
-                
-            nodes.append((dir_name, unknown, entrycount, entryoffset))
+        nodes = []
+        entry_count = 0
+        for nodetype, nameoffset, unknown, entrycount, entryoffset in iter_unpack(">4sIHHI", f.read(node_count*16)):
+            nodes.append((nameoffset, unknown, entrycount, entryoffset))
+            entry_count = max(entry_count, entryoffset + entrycount)
+
+        f.seek(file_entry_offset)
+        entries = list(iter_unpack(">HHBBHIII", f.read(entry_count*20)))
+
+        f.seek(stringtable_offset)
+        names = StringTableNames(f.read(stringtable_size))
+
+        # Only the root node's name is used, the names of the other nodes come from their directory entries
+        nodes = [(names[nodes[0][0]],) + nodes[0][1:]] + [(None,) + node[1:] for node in nodes[1:]]
 
         rootfoldername = nodes[0][0]
-        newarc.root = Directory.from_node(f, rootfoldername, stringtable_offset, file_entry_offset, data_offset, nodes, 0)
+        newarc.root = Directory.from_node(f, rootfoldername, names, entries, data_offset, nodes, 0,
+                                          source=source)
+
+        if source is not None:
+            newarc._source = source
+            newarc._size = size
+            newarc._data_offset = data_offset
+            newarc._file_entry_offset = file_entry_offset
+            newarc._entry_count = entry_count
+            newarc._structure = newarc._get_structure()
         
         return newarc
 
+    def _get_structure(self):
+        # Names of all directories and files along with the entries the files were read from,
+        # if any of these change the archive can't be written incrementally anymore.
+        structure = []
+        for dir in self.root.walk_dirs():
+            files = [(name, file._entry) for name, file in dir.files.items()]
+            structure.append((dir.name, files, list(dir.subdirs.keys())))
+
+        return structure
+
+    def _get_changed_files(self):
+        # Returns the (entry, new data) of every file whose data differs from the data it was read with,
+        # sorted by data offset, or None if the archive can't be written incrementally.
+        if self._source is None or self._get_structure() != self._structure:
+            return None
+
+        changes = []
+        for dir in self.root.walk_dirs():
+            for file in dir.files.values():
+                if file.is_lazy():
+                    continue
+
+                entry_index, offset, size = file._entry
+                start = self._data_offset + offset
+                data = file.getvalue()
+                if data != bytes(self._source[start:start+size]):
+                    changes.append((file._entry, data))
+
+        # Empty files can share their offset with the next file, they have to come first so that the data
+        # they get is laid out before that file's data, where their new offset points.
+        changes.sort(key=lambda change: (change[0][1], change[0][2], change[0][0]))
+        return changes
+
+    def write_arc_incremental(self, f, in_place=False):
+        # Writes the archive by splicing the data of changed files into the data it was read from
+        # instead of laying out the whole archive again. Files that still fit in their 0x20-aligned slot
+        # are written over their old data, otherwise the data after them is moved and only the data
+        # offsets of the files after them are changed.
+        # If in_place is set, f must contain the archive as it was read from its start, and only the
+        # changed parts of it are written. Archives not read in lazy mode, or with added, removed or renamed files or
+        # directories, are written completely. So are archives patched in place that were read from Yaz0 data,
+        # as f then holds the compressed archive rather than the one the offsets refer to.
+        changes = self._get_changed_files()
+        if in_place and self._source_yaz0:
+            changes = None
+        if changes is None:
+            log.debug("Archive can't be written incrementally, writing complete archive")
+            if in_place:
+                f.seek(0)
+            self.write_arc_uncompressed(f)
+            if in_place:
+                f.truncate()
+            return
+
+        source = self._source
+        data_offset = self._data_offset
+        file_entry_offset = self._file_entry_offset
+        entries = bytearray(source[file_entry_offset:file_entry_offset + self._entry_count*20])
+        changed_entries = []
+
+        # Decide the new slot of every changed file and how far the data after its old slot moves
+        shift_ends = []
+        shifts = []
+        slots = []
+        new_offsets = {}
+        total_shift = 0
+        first_moved = len(changes)
+        for i, ((entry_index, offset, size), data) in enumerate(changes):
+            old_slot = (size + 0x1F) & ~0x1F
+            new_slot = max(old_slot, (len(data) + 0x1F) & ~0x1F)
+            slots.append((offset, old_slot, new_slot))
+            new_offsets[entry_index] = offset + total_shift
+
+            if new_slot != old_slot:
+                total_shift += new_slot - old_slot
+                shift_ends.append(offset + old_slot)
+                shifts.append(total_shift)
+                first_moved = min(first_moved, i)
+
+            entries[entry_index*20+12:entry_index*20+16] = pack(">I", len(data))
+            changed_entries.append(entry_index)
+
+        if total_shift:
+            for entry_index, (flags, fileoffset) in enumerate(unpack_entry_flags_and_offsets(entries)):
+                if (flags & DIRECTORY) != 0 and not (flags & FILE):
+                    continue
+
+                if entry_index in new_offsets:
+                    new_offset = new_offsets[entry_index]
+                else:
+                    # Shift by the growth of all changed files whose old slot ends before this file
+                    i = bisect_right(shift_ends, fileoffset)
+                    new_offset = fileoffset + shifts[i-1] if i > 0 else fileoffset
+
+                if new_offset != fileoffset:
+                    entries[entry_index*20+8:entry_index*20+12] = pack(">I", new_offset)
+                    changed_entries.append(entry_index)
+
+        header = bytearray(source[:0x40])
+        data_size = self._size - data_offset + total_shift
+        header[4:8] = pack(">I", self._size + total_shift)
+        header[16:24] = pack(">II", data_size, data_size)
+
+        if in_place:
+            f.seek(0)
+            f.write(header)
+            for entry_index in changed_entries:
+                f.seek(file_entry_offset + entry_index*20)
+                f.write(entries[entry_index*20:entry_index*20+20])
+
+            # Files that fit into their old slot, before any data that has to be moved
+            for ((entry_index, offset, size), data), (offset, old_slot, new_slot) in zip(changes[:first_moved],
+                                                                                        slots[:first_moved]):
+                f.seek(data_offset + offset)
+                f.write(data)
+                f.write(b"\x00"*(new_slot - len(data)))
+
+            if first_moved == len(changes):
+                return
+
+            position = slots[first_moved][0]
+            f.seek(data_offset + position)
+        else:
+            first_moved = 0
+            position = 0
+            f.write(header)
+            f.write(source[0x40:file_entry_offset])
+            f.write(entries)
+            f.write(source[file_entry_offset+len(entries):data_offset])
+
+        # Write everything from the first moved file on, taking unchanged data straight from the source
+        for ((entry_index, offset, size), data), (offset, old_slot, new_slot) in zip(changes[first_moved:],
+                                                                                    slots[first_moved:]):
+            f.write(source[data_offset+position:data_offset+offset])
+            f.write(data)
+            f.write(b"\x00"*(new_slot - len(data)))
+            position = offset + old_slot
+
+        f.write(source[data_offset+position:self._size])
+        if in_place:
+            f.truncate()
+
 
     def listdir(self, path):
         if path == ".":
@@ -540,7 +1092,104 @@ class Archive(object):
             entries.extend(dir.subdirs.keys())
             return entries
 
+    def _update_index(self):
+        index_key = (self.root, self.root._generation)
+        if self._index_key == index_key:
+            return
+
+        self._entries_by_path = {}
+        self._entries_by_path_lowercase = {}
+        self._index_dir_paths = {}
+        self._index_case_collisions = False
+        self._index_add(self.root.name, self.root)
+
+        # From now on, changes to the tree are applied to the index as they're made instead of building it again
+        self.root._path_index = self
+        self._index_key = index_key
+
+    def _index_add(self, path, entry):
+        lowercase_path = path.lower()
+        if self._entries_by_path_lowercase.get(lowercase_path, entry) is not entry:
+            self._index_case_collisions = True
+
+        self._entries_by_path[path] = entry
+        self._entries_by_path_lowercase[lowercase_path] = entry
+
+        if isinstance(entry, Directory):
+            self._index_dir_paths[entry] = path
+            for name, file in entry.files.items():
+                self._index_add(path + "/" + name, file)
+            for name, subdir in entry.subdirs.items():
+                self._index_add(path + "/" + name, subdir)
+
+    def _index_remove(self, path, entry):
+        # Returns False if the index has to be built again, because another path that only differs in case
+        # from a removed one can't be found without ignoring case anymore.
+        if self._entries_by_path.get(path) is entry:
+            del self._entries_by_path[path]
+
+        lowercase_path = path.lower()
+        if self._entries_by_path_lowercase.get(lowercase_path) is entry:
+            if self._index_case_collisions:
+                return False
+            del self._entries_by_path_lowercase[lowercase_path]
+
+        if isinstance(entry, Directory):
+            self._index_dir_paths.pop(entry, None)
+            for name, file in entry.files.items():
+                if not self._index_remove(path + "/" + name, file):
+                    return False
+            for name, subdir in entry.subdirs.items():
+                if not self._index_remove(path + "/" + name, subdir):
+                    return False
+
+        return True
+
+    def _index_entry_changed(self, top, directory, name, old_entry, new_entry):
+        # Applies a change to the entries of a directory to the index. Nothing is done if the index was already
+        # outdated before the change, in which case it's built again on the next lookup.
+        if top is not self.root or self._index_key != (top, top._generation - 1):
+            return
+
+        dirpath = self._index_dir_paths.get(directory)
+        if dirpath is not None:
+            # A file and a subdirectory with the same name have the same path, in which the subdirectory wins
+            if name in directory.files and name in directory.subdirs:
+                return
+
+            path = dirpath + "/" + name
+            if old_entry is not None and not self._index_remove(path, old_entry):
+                return
+            if new_entry is not None:
+                self._index_add(path, new_entry)
+
+        self._index_key = (top, top._generation)
+
+    def _index_dir_renamed(self, top, directory):
+        # Paths are made of the names directories are stored under in their parent, so only
+        # renaming the topmost directory changes them and needs the index to be built again.
+        if top is not self.root or self._index_key != (top, top._generation - 1) or directory is top:
+            return
+
+        self._index_key = (top, top._generation)
+
+    def find(self, path, ignore_case=False):
+        # Returns the file or directory at path, or None if it doesn't exist.
+        self._update_index()
+        path = path.replace("\\", "/").rstrip("/")
+        if ignore_case:
+            return self._entries_by_path_lowercase.get(path.lower())
+        else:
+            return self._entries_by_path.get(path)
+
+    def exists(self, path, ignore_case=False):
+        return self.find(path, ignore_case) is not None
+
     def __getitem__(self, path):
+        entry = self.find(path)
+        if entry is not None:
+            return entry
+
         dirname, rest = split_path(path)
 
         if rest is None or rest.strip() == "":
@@ -564,8 +1213,33 @@ class Archive(object):
         else:
             self.root[rest] = entry
 
-    def extract_to(self, path):
-        self.root.extract_to(path)
+    def extract_to(self, path, workers=1):
+        # With more than one worker, the directories are created first and the files are written on a pool
+        # of threads, except for yaz0 compressed files, which are decompressed and written on a pool of processes.
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers <= 1:
+            self.root.extract_to(path)
+            return
+
+        dirpaths = {}
+        for dir in self.root.walk_dirs():
+            parentpath = path if dir.parent is None else dirpaths[dir.parent]
+            dirpaths[dir] = os.path.join(parentpath, dir.name)
+            os.makedirs(dirpaths[dir], exist_ok=True)
+
+        with ProcessPoolExecutor(max_workers=workers) as processes, ThreadPoolExecutor(max_workers=workers) as threads:
+            jobs = []
+            for dir in self.root.walk_dirs():
+                for filename, file in dir.files.items():
+                    filepath = os.path.join(dirpaths[dir], filename)
+                    if file.peek(4) == b"Yaz0":
+                        jobs.append(processes.submit(_extract_yaz0_file, filepath, file.getvalue()))
+                    else:
+                        jobs.append(threads.submit(_extract_file, filepath, file))
+
+            for job in jobs:
+                job.result()
 
     def write_arc_compressed(self, f, compression_settings, filelisting = None, maxindex = 0):
         temp = BytesIO()
@@ -573,7 +1247,12 @@ class Archive(object):
         temp.seek(0)
         
         if compression_settings.yaz0_fast:
-            compress_fast(temp, f)
+            # Fastest level of the built-in compressor
+            f.write(compress_parallel(temp.getvalue(), compression_settings.workers, 1,
+                                      compression_settings.cache))
+        elif compression_settings.yaz0:
+            f.write(compress_parallel(temp.getvalue(), compression_settings.workers, compression_settings.yaz0_level,
+                                      compression_settings.cache))
         elif compression_settings.wszst:
             data = compression_settings.run_wszst(temp)
         
@@ -583,13 +1262,11 @@ class Archive(object):
         self.write_arc(f, CompressionSetting())
         
     def write_arc(self, f, compression_settings, filelisting=None, maxindex=0):
-        
+        # The complete layout (node table, file entries, string table and data offsets) is computed first,
+        # after which everything is written to f in order. File data is written straight from each file's
+        # buffer (or the buffer a lazy archive was read from) without intermediate copies.
         stringtable = StringTable()
 
-        nodes = BytesIO()
-        entries = BytesIO()
-        data = BytesIO()
-
         nodecount = 1
         entries = 0
 
@@ -608,39 +1285,12 @@ class Archive(object):
             for name in filenames:
                 stringtable.write_string(name)
 
-        f.write(b"RARC")
-        f.write(b"FOO ") # placeholder for filesize
-        write_uint32(f, 0x20)  #Unknown but often 0x20?
-        f.write(b"BAR ") # placeholder for data offset
-        f.write(b"\x00"*16) # 4 unknown ints
-
-        write_uint32(f, nodecount)
-        write_uint32(f, 0x20) # unknown
-        f.write(b"\x00"*4) # 1 unknown ints
-
-        #aligned_file_entry_offset = (0x20 + 44 + (nodecount*16) + 0x1F) & 0x20
-        #write_uint32(f, aligned_file_entry_offset)  # Offset to file entries aligned to multiples of 0x20
-        write_uint32(f, 0xF0F0F0F0)
-
-        f.write(b"\x00"*4) # 1 unknown int
-
-        #aligned_stringtable_offset = aligned_file_entry_offset + ((entries * 20) + 0x1F) & 0x20
-        #write_uint32(f, aligned_stringtable_offset)
-        write_uint32(f, 0xF0F0F0F0)
-
-        f.write(b"\x00"*8) # 2 unknown ints
-
-        node_offset = f.tell()
-
+        nodes = bytearray()
         first_file_entry_index = 0
 
         dirlist = []
 
-        #aligned_data_offset = aligned_stringtable_offset + (stringtable.size() + 0x1F) & 0x20
-
-        for i, dirinfo in enumerate(self.root.walk()):
-            dirpath, dirnames, filenames = dirinfo
-            dir = self[dirpath]
+        for i, dir in enumerate(self.root.walk_dirs()):
             dir._nodeindex = i
 
             dirlist.append(dir)
@@ -652,140 +1302,367 @@ class Archive(object):
                 if len(nodetype) < 4:
                     nodetype = nodetype + (b"\x00"*(4 - len(nodetype)))
 
-            f.write(nodetype)
-            write_uint32(f, stringtable.get_string_offset(dir.name))
-            hash = hash_name(dir.name)
-
-            entrycount = len(dirnames) + len(filenames)
-            write_uint16(f, hash)
-            write_uint16(f, entrycount+2)
+            entrycount = len(dir.subdirs) + len(dir.files)
 
-            write_uint32(f, first_file_entry_index)
+            nodes += nodetype
+            nodes += pack(">IHHI", stringtable.get_string_offset(dir.name), hash_name(dir.name),
+                          entrycount+2, first_file_entry_index)
             first_file_entry_index += entrycount + 2 # Each directory has two special entries being the current and the parent directories
 
-        write_pad32(f)
-
-        current_file_entry_offset = f.tell()
-        #assert f.tell() == aligned_file_entry_offset
-        fileid = maxindex
+        file_entries = bytearray()
+        filedata = [] # Data of every file in the order it is written
+        try:
+            data_size = 0
+            fileid = maxindex
         
-        def key_compare(val):
-            #if filelisting is not None:
-            #    if val[0] in filelisting:
-            #        return filelisting[val[0]][0]
-            return maxindex + 1
+            def key_compare(val):
+                #if filelisting is not None:
+                #    if val[0] in filelisting:
+                #        return filelisting[val[0]][0]
+                return maxindex + 1
         
-        for dir in dirlist:
-            log.debug(f"Hello {dir.absolute_path()}")
-            abspath = dir.absolute_path()   
-            files = []
+            # Files flagged as yaz0 compressed are compressed before the layout is computed, all at once so that
+            # they are compressed concurrently. Files whose data is already yaz0 compressed are written as they are.
+            compressed = {}
+            if filelisting is not None:
+                to_compress = []
+                for dir in dirlist:
+                    abspath = dir.absolute_path()
+                    for filename, file in dir.files.items():
+                        if abspath+"/"+filename in filelisting:
+                            filemeta = filelisting[abspath+"/"+filename][1]
+                            if filemeta.is_yaz0 and filemeta.is_compressed and file.peek(4) != b"Yaz0":
+                                to_compress.append(file)
+
+                for file, data in zip(to_compress, compression_settings.compress_members(to_compress)):
+                    compressed[file] = data
+
+            for dir in dirlist:
+                log.debug(f"Hello {dir.absolute_path()}")
+                abspath = dir.absolute_path()   
+                files = []
             
-            for filename, file in dir.files.items():
-                files.append((abspath+"/"+filename, file))
+                for filename, file in dir.files.items():
+                    files.append((abspath+"/"+filename, file))
             
-            files.sort(key=key_compare)            
+                files.sort(key=key_compare)            
             
             
-            for filepath, file in files:
-                filemeta = FileListing.default()
-                if filelisting is not None:
-                    if filepath in filelisting:
-                        fileid, filemeta = filelisting[filepath]
-                        write_uint16(f, fileid)
-                        log.debug(f"found filemeta")
+                for filepath, file in files:
+                    filemeta = FileListing.default()
+                    if filelisting is not None:
+                        if filepath in filelisting:
+                            fileid, filemeta = filelisting[filepath]
+                            log.debug(f"found filemeta")
+                    filename = file.name 
+                    log.debug(f"Writing filemeta {str(filemeta)}")
+
+                    if file in compressed:
+                        data = compressed[file]
+                    elif file.is_spilled():
+                        data = file._data # Streamed from disk when the data is written
                     else:
-                        write_uint16(f, fileid)
-                else:
-                    write_uint16(f, fileid)
-                filename = file.name 
-                write_uint16(f, hash_name(filename))
-                log.debug(f"Writing filemeta {str(filemeta)}")
-                write_uint8(f, filemeta.to_flags())
-                write_uint8(f, 0) # padding 
-                #f.write(b"\x11\x00") # Flag for file+padding
-                write_uint16(f, stringtable.get_string_offset(filename))
-
-                filedata_offset = data.tell()
-                write_uint32(f, filedata_offset) # Write file data offset
-                
-                if filemeta.is_yaz0 and filemeta.is_compressed:
-                    log.debug("so far so gud")
-                    if compression_settings.wszst:
-                        log.debug("doing wszst thing")
-                        compressed_data = compression_setting.run_wszst(file)
-                        data.write(compressed_data)
-                    else:
-                        # if file was yaz0 compressed then always yaz0fast compress even if wszst is not set
-                        #yaz0.compress_fast(file, data)
-                        data.write(file.getvalue())
-                else:
-                    data.write(file.getvalue()) # Write file data
-                
-                
-                write_uint32(f, data.tell()-filedata_offset) # Write file size
-                write_pad32(data)
-                write_uint32(f, 0)
-
-                fileid += 1
+                        data = file.view() # Write file data
 
-            specialdirs = [(".", dir), ("..", dir.parent)]
+                    filesize = len(data)
+                    filedata.append(data)
 
-            for subdirname, subdir in chain(specialdirs, dir.subdirs.items()):
-                write_uint16(f, 0xFFFF)
-                write_uint16(f, hash_name(subdirname))
-                f.write(b"\x02\x00") # Flag for directory+padding
-                write_uint16(f, stringtable.get_string_offset(subdirname))
+                    file_entries += pack(">HHBBHIII", fileid, hash_name(filename), filemeta.to_flags(), 0,
+                                         stringtable.get_string_offset(filename), data_size, filesize, 0)
+                    data_size += (filesize + 0x1F) & ~0x1F
 
-                if subdir is None:
-                    child_nodeindex = 0xFFFFFFFF
-                else:
-                    child_nodeindex = subdir._nodeindex
-                write_uint32(f, child_nodeindex)
-                write_uint32(f, 0x10)
-                write_uint32(f, 0) # Padding
+                    fileid += 1
 
-        write_pad32(f)
-        assert f.tell() % 0x20 == 0
-        current_stringtable_offset = f.tell()
-        stringtable.write_to(f)
+                specialdirs = [(".", dir), ("..", dir.parent)]
 
-        write_pad32(f)
-        stringtablesize = f.tell() - current_stringtable_offset
-
-        current_data_offset = f.tell()
-
-        f.write(data.getvalue())
-
-        rarc_size = f.tell()
+                for subdirname, subdir in chain(specialdirs, dir.subdirs.items()):
+                    if subdir is None:
+                        child_nodeindex = 0xFFFFFFFF
+                    else:
+                        child_nodeindex = subdir._nodeindex
+
+                    # Flag for directory+padding
+                    file_entries += pack(">HHBBHIII", 0xFFFF, hash_name(subdirname), DIRECTORY, 0,
+                                         stringtable.get_string_offset(subdirname), child_nodeindex, 0x10, 0)
+
+            node_offset = 0x40
+            file_entry_offset = (node_offset + len(nodes) + 0x1F) & ~0x1F
+            stringtable_offset = (file_entry_offset + len(file_entries) + 0x1F) & ~0x1F
+            stringtablesize = (stringtable.size() + 0x1F) & ~0x1F
+            data_offset = stringtable_offset + stringtablesize
+            rarc_size = data_offset + data_size
+
+            f.write(b"RARC")
+            f.write(pack(">IIIII", rarc_size, 0x20, data_offset-0x20, data_size, data_size))
+            f.write(b"\x00"*8) # 2 unknown ints
+            f.write(pack(">IIIIII", nodecount, node_offset-0x20, first_file_entry_index,
+                         file_entry_offset-0x20, stringtablesize, stringtable_offset-0x20))
+            f.write(b"\x00"*8) # 2 unknown ints
+
+            f.write(nodes)
+            f.write(b"\x00"*(file_entry_offset - node_offset - len(nodes)))
+            f.write(file_entries)
+            f.write(b"\x00"*(stringtable_offset - file_entry_offset - len(file_entries)))
+            stringtable.write_to(f)
+            f.write(b"\x00"*(stringtablesize - stringtable.size()))
+
+            padding = b"\x00"*0x20
+            for data in filedata:
+                if isinstance(data, SpillFile):
+                    data.write_to(f)
+                else:
+                    f.write(data)
+                f.write(padding[:-len(data) & 0x1F])
+        finally:
+            # Release the views into the files' buffers so they can be resized again, also if writing failed
+            for data in filedata:
+                if isinstance(data, memoryview):
+                    data.release()
 
-        f.seek(4)
-        write_uint32(f, rarc_size)
-        f.seek(12)
-        write_uint32(f, current_data_offset-0x20)
-        write_uint32(f, rarc_size - current_data_offset)
-        write_uint32(f, rarc_size - current_data_offset)
 
-        f.seek(40)
+def get_default_output_path(inputpath, compressed=False):
+    # Archives are extracted to <name>_ext, directories ending in _ext are packed to the name without it
+    path, name = os.path.split(inputpath)
 
-        total_file_entries = first_file_entry_index
-        write_uint32(f, total_file_entries)
-        write_uint32(f, current_file_entry_offset-0x20)
-        write_uint32(f, stringtablesize)
-        write_uint32(f, current_stringtable_offset-0x20)
+    if os.path.isdir(inputpath):
+        if compressed:
+            ending = ".szs"
+        else:
+            ending = ".arc"
 
+        if inputpath.endswith("_ext"):
+            return inputpath[:-4]
+        else:
+            return inputpath + ending
+    else:
+        return os.path.join(path, name+"_ext")
+
+
+def read_filelisting(path):
+    filelisting = {}
+    maxindex = 0
+    try: 
+        with open(path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith("#"): continue 
+                result = line.split(" ")
+                if len(result) == 2:
+                    filepath, fileid = result 
+                    filelisting_meta = FileListing.default()
+                else:
+                    filepath, fileid, metadata = result 
+                    filelisting_meta = FileListing.from_string(metadata)
+                    log.debug(f"{metadata} {filelisting_meta}")
+                
+                filelisting[filepath] = (int(fileid), filelisting_meta)
+                if int(fileid) > maxindex:
+                    maxindex = int(fileid)
+    except:
+        log.debug("no filelisting")
+        pass
 
+    return filelisting, maxindex
 
 
+def pack_directory(inputpath, outputpath, compression_setting):
+    dirscan = os.scandir(inputpath)
+    inputdir = None 
+    
+    for entry in dirscan:
+        if entry.is_dir():
+            if inputdir is None:
+                inputdir = entry.name
+            else:
+                raise RuntimeError("Directory {0} contains multiple folders! Only one folder should exist.".format(inputpath))
+    
+    if inputdir is None:
+        raise RuntimeError("Directory {0} contains no folders! Exactly one folder should exist.".format(inputpath))
+    
+    log.debug("Packing directory to archive")
+    archive = Archive.from_dir(os.path.join(inputpath, inputdir))
+    filelisting, maxindex = read_filelisting(os.path.join(inputpath, "filelisting.txt"))
+    
+    log.debug("Directory loaded into memory, writing archive now")
+    
+    with open(outputpath, "wb") as f:
+        if compression_setting.yaz0_fast or compression_setting.yaz0 or compression_setting.wszst:
+            archive.write_arc_compressed(f, compression_setting, filelisting, maxindex)
+        else:
+            archive.write_arc(f, compression_setting, filelisting, maxindex)
+    log.debug("Done")
 
 
+def extract_archive(inputpath, outputpath, workers=1):
+    log.debug("Extracting archive to directory")
+    with open(inputpath, "rb") as f:
+        archive = Archive.from_file(f)
+    archive.extract_to(outputpath, workers)
+    
+    with open(os.path.join(outputpath, "filelisting.txt"), "w") as f:
+        f.write("# DO NOT TOUCH THIS FILE\n")
+        for dirpath, dirnames, filenames in archive.root.walk():
+            currentdir = archive[dirpath]
+            #for name in dirnames:
+            #    
+            #    dir = currentdir[name]
+            #    f.write(dirpath+"/"+name)
+            #    f.write("\n")
+                
+            for name in filenames:
+                file = currentdir[name]
+                f.write(dirpath+"/"+name)
+                f.write(" ")
+                f.write(str(file._fileid))
+                meta = file.filetype.to_string()
+                log.debug(f"{hex(file._flags)} {file.filetype.to_string()}")
+                if meta:
+                    f.write(" ")
+                    f.write(meta)
+                f.write("\n")
 
 
+BATCH_ARCHIVE_ENDINGS = (".arc", ".szs")
 
 
+def find_batch_inputs(patterns):
+    # Every pattern is an archive, an extracted archive (a directory with a filelisting.txt), a directory
+    # that is searched for both or a glob pattern matching any of these.
+    inputs = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            paths = sorted(glob.glob(pattern, recursive=True))
+        else:
+            paths = [pattern]
 
+        for path in paths:
+            path = os.path.normpath(path)
+            if not os.path.isdir(path) or os.path.exists(os.path.join(path, "filelisting.txt")):
+                inputs.append(path)
+                continue
 
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for dirname in dirnames[:]:
+                    if os.path.exists(os.path.join(dirpath, dirname, "filelisting.txt")):
+                        inputs.append(os.path.join(dirpath, dirname))
+                        dirnames.remove(dirname) # Don't look for archives inside of extracted archives
+                for filename in sorted(filenames):
+                    if filename.lower().endswith(BATCH_ARCHIVE_ENDINGS):
+                        inputs.append(os.path.join(dirpath, filename))
+
+    # Patterns can overlap, but every input is only processed once
+    unique_inputs = []
+    seen = set()
+    for inputpath in inputs:
+        key = os.path.normcase(os.path.abspath(inputpath))
+        if key not in seen:
+            seen.add(key)
+            unique_inputs.append(inputpath)
+
+    return unique_inputs
+
+
+def find_batch_conflicts(inputs, compressed=False):
+    # Inputs can't be processed at the same time if one of them writes to another one's input, e.g. x.arc
+    # and x.arc_ext, or if they write to the same output. Returns the reason for every input that conflicts.
+    def key(path):
+        return os.path.normcase(os.path.abspath(path))
+
+    input_keys = {key(inputpath): inputpath for inputpath in inputs}
+    outputs = {}
+    for inputpath in inputs:
+        outputs.setdefault(key(get_default_output_path(inputpath, compressed)), []).append(inputpath)
+
+    conflicts = {}
+    for output_key, writers in outputs.items():
+        if output_key in input_keys:
+            reader = input_keys[output_key]
+            for writer in writers:
+                conflicts[writer] = "output is {0}, which is also an input of this batch".format(reader)
+            conflicts.setdefault(reader, "it is the output of {0}, which is also an input of this batch".format(
+                writers[0]))
+        if len(writers) > 1:
+            for writer in writers:
+                conflicts.setdefault(writer, "{0} inputs have the same output".format(len(writers)))
+
+    return conflicts
+
+
+def get_total_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            if filename != "filelisting.txt":
+                size += os.path.getsize(os.path.join(dirpath, filename))
+    return size
+
+
+def run_batch_job(inputpath, compression_setting):
+    # Packs or extracts one input of a batch and returns a summary of it.
+    dir2arc = os.path.isdir(inputpath)
+    outputpath = get_default_output_path(inputpath, compression_setting.yaz0_fast or compression_setting.yaz0)
+    summary = {"input": inputpath, "output": outputpath, "mode": "pack" if dir2arc else "extract", "error": None}
+
+    start = time.time()
+    try:
+        if dir2arc:
+            pack_directory(inputpath, outputpath, compression_setting)
+        else:
+            extract_archive(inputpath, outputpath)
+    except Exception as error:
+        summary["error"] = "{0}: {1}".format(type(error).__name__, error)
+        return summary
+    summary["time"] = time.time() - start
+
+    # The ratio is always the size of the archive relative to the size of the files in it
+    summary["input_size"] = get_total_size(inputpath)
+    summary["output_size"] = get_total_size(outputpath)
+    if dir2arc:
+        archive_size, content_size = summary["output_size"], summary["input_size"]
+    else:
+        archive_size, content_size = summary["input_size"], summary["output_size"]
+    summary["ratio"] = archive_size/content_size if content_size else 1.0
+
+    return summary
+
+
+def run_batch(inputs, compression_setting, workers=None):
+    # Every input is processed on its own process, so the archives themselves are packed and extracted
+    # with a single worker each.
+    compression_setting.workers = 1
+    compressed = compression_setting.yaz0_fast or compression_setting.yaz0
+    results = []
+    start = time.time()
+
+    # Inputs that would overwrite each other's input are refused rather than racing each other,
+    # which of them should win isn't clear.
+    conflicts = find_batch_conflicts(inputs, compressed)
+    for inputpath in inputs:
+        if inputpath in conflicts:
+            summary = {"input": inputpath, "output": get_default_output_path(inputpath, compressed),
+                       "mode": "pack" if os.path.isdir(inputpath) else "extract",
+                       "error": "Skipped, " + conflicts[inputpath]}
+            results.append(summary)
+            print("{mode:>7} {input}: FAILED, {error}".format(**summary))
+
+    jobs = [inputpath for inputpath in inputs if inputpath not in conflicts]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for summary in executor.map(run_batch_job, jobs, repeat(compression_setting)):
+            results.append(summary)
+            if summary["error"] is not None:
+                print("{mode:>7} {input}: FAILED, {error}".format(**summary))
+            else:
+                print("{mode:>7} {input} -> {output}: {time:.2f}s, {input_size} -> {output_size} bytes, "
+                      "ratio {ratio:.3f}".format(**summary))
 
+    failed = sum(1 for summary in results if summary["error"] is not None)
+    print("Processed {0} inputs in {1:.2f}s, {2} failed".format(len(results), time.time() - start, failed))
 
+    return results
 
 
 if __name__ == "__main__":
@@ -793,10 +1670,21 @@ if __name__ == "__main__":
     import os
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("input",
+    parser.add_argument("input", nargs="?",
                         help="Path to the archive file (usually .arc or .szs) to be extracted or the directory to be packed into an archive file.")
     parser.add_argument("--yaz0fast", action="store_true",
-                        help="Encode archive as yaz0 when doing directory->.arc/.szs")
+                        help="Encode archive as yaz0 using the fastest compression level when doing directory->.arc/.szs")
+    parser.add_argument("--yaz0", action="store_true",
+                        help="Compress archive with the built-in yaz0 compressor when doing directory->.arc/.szs")
+    parser.add_argument("--yaz0_level", default=DEFAULT_LEVEL, type=int, choices=range(0, 10),
+                        help=("Set the compression level for the built-in yaz0 compressor. "
+                        "Possible values are 0..9 with 0 storing the data uncompressed, 1 being fastest and 9 being the best and slowest."))
+    parser.add_argument("--workers", default=None, type=int,
+                        help="Number of processes used for yaz0 compression and for extracting files. Defaults to the number of CPU cores.")
+    parser.add_argument("--cache_dir", default=None,
+                        help="Directory in which compression results are cached so unchanged archives aren't compressed again.")
+    parser.add_argument("--cache_size", default=DEFAULT_MAX_SIZE // (1024*1024), type=int,
+                        help="Maximum size of the compression cache in MiB. Least recently used entries are removed first.")
     parser.add_argument("--wszst", action="store_true",
                         help="Use wszst (Wimms SZS tools) for yaz0 compression when doing directory->arc/.szs. wszst needs to be installed separately")
     parser.add_argument("--wszst_comprlevel", default="9",
@@ -804,111 +1692,34 @@ if __name__ == "__main__":
                         "Possible values are 0..10 with 0 being worst, 9 being the default and best and 10 being ultra and most time consuming."))
     parser.add_argument("output", default=None, nargs = '?',
                         help="Output path to which the archive is extracted or a new archive file is written, depending on input.")
+    parser.add_argument("--batch", nargs="+", default=None, metavar="INPUT",
+                        help=("Extract or pack many inputs at once on a pool of --workers processes and print a summary of each. "
+                        "Inputs are archives, extracted archive directories, directories searched for both or glob patterns. "
+                        "Outputs are written to the default output paths."))
 
     args = parser.parse_args()
 
-    inputpath = os.path.normpath(args.input)
-    if os.path.isdir(inputpath):
-        dir2arc = True
-    else:
-        dir2arc = False
+    if args.batch is None and args.input is None:
+        parser.error("input is required unless --batch is used")
 
-    compression_setting = CompressionSetting(args.yaz0fast, args.wszst, args.wszst_comprlevel)
+    compression_setting = CompressionSetting(args.yaz0fast, args.wszst, args.wszst_comprlevel, args.yaz0, args.yaz0_level,
+                                             args.workers)
+    if args.cache_dir is not None:
+        compression_setting.cache = CompressionCache(args.cache_dir, args.cache_size*1024*1024)
     log.debug(f"Use wszst? {args.wszst}")
+
+    if args.batch is not None:
+        results = run_batch(find_batch_inputs(args.batch), compression_setting, args.workers)
+        sys.exit(1 if any(summary["error"] is not None for summary in results) else 0)
+
+    inputpath = os.path.normpath(args.input)
     
     if args.output is None:
-        path, name = os.path.split(inputpath)
-
-        if dir2arc:
-            if args.yaz0fast:
-                ending = ".szs"
-            else:
-                ending = ".arc"
-            
-            if inputpath.endswith("_ext"):
-                outputpath = inputpath[:-4]
-            else:
-                outputpath = inputpath + ending 
-        else:
-            outputpath = os.path.join(path, name+"_ext")
+        outputpath = get_default_output_path(inputpath, args.yaz0fast or args.yaz0)
     else:
         outputpath = args.output
 
-    if dir2arc:
-        dirscan = os.scandir(inputpath)
-        inputdir = None 
-        
-        for entry in dirscan:
-            if entry.is_dir():
-                if inputdir is None:
-                    inputdir = entry.name
-                else:
-                    raise RuntimeError("Directory {0} contains multiple folders! Only one folder should exist.".format(inputpath))
-        
-        if inputdir is None:
-            raise RuntimeError("Directory {0} contains no folders! Exactly one folder should exist.".format(inputpath))
-        
-        log.debug("Packing directory to archive")
-        archive = Archive.from_dir(os.path.join(inputpath, inputdir))
-        filelisting = {}
-        maxindex = 0
-        try: 
-            with open(os.path.join(inputpath, "filelisting.txt"), "r") as f:
-                for line in f:
-                    line = line.strip()
-                    if line.startswith("#"): continue 
-                    result = line.split(" ")
-                    if len(result) == 2:
-                        path, fileid = result 
-                        filelisting_meta = FileListing.default()
-                    else:
-                        path, fileid, metadata = result 
-                        filelisting_meta = FileListing.from_string(metadata)
-                        log.debug(f"{metadata} {filelisting_meta}")
-                    
-                    filelisting[path] = (int(fileid), filelisting_meta)
-                    if int(fileid) > maxindex:
-                        maxindex = int(fileid)
-        except:
-            log.debug("no filelisting")
-            pass
-        
-        log.debug("Directory loaded into memory, writing archive now")
-        
-        
-        
-        with open(outputpath, "wb") as f:
-            if args.yaz0fast or args.wszst:
-                archive.write_arc_compressed(f, compression_setting, filelisting, maxindex)
-            else:
-                archive.write_arc(f, compression_setting, filelisting, maxindex)
-        log.debug("Done")
+    if os.path.isdir(inputpath):
+        pack_directory(inputpath, outputpath, compression_setting)
     else:
-        log.debug("Extracting archive to directory")
-        with open(inputpath, "rb") as f:
-            archive = Archive.from_file(f)
-        archive.extract_to(outputpath)
-        
-        with open(os.path.join(outputpath, "filelisting.txt"), "w") as f:
-            f.write("# DO NOT TOUCH THIS FILE\n")
-            for dirpath, dirnames, filenames in archive.root.walk():
-                currentdir = archive[dirpath]
-                #for name in dirnames:
-                #    
-                #    dir = currentdir[name]
-                #    f.write(dirpath+"/"+name)
-                #    f.write("\n")
-                    
-                for name in filenames:
-                    file = currentdir[name]
-                    f.write(dirpath+"/"+name)
-                    f.write(" ")
-                    f.write(str(file._fileid))
-                    meta = file.filetype.to_string()
-                    log.debug(f"{hex(file._flags)} {file.filetype.to_string()}")
-                    if meta:
-                        f.write(" ")
-                        f.write(meta)
-                    f.write("\n")
-
-
+        extract_archive(inputpath, outputpath, args.workers)
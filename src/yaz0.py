@@ -9,6 +9,8 @@ import math
 import hashlib
 import logging
 
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
 from struct import unpack, pack
 from timeit import default_timer as time
@@ -37,104 +39,255 @@ def write_limited(f, data, limit):
     else:
         f.write(data)
     
-def decompress(f, out, suppress_error=False):
-    #if out is None:
-    #    out = BytesIO()
-    
-    # A way to discover the total size of the input data that
-    # should be compatible with most file-like objects.
-    f.seek(0, 2)
-    maxsize = f.tell()
-    f.seek(0)
-    
-    
-    header = f.read(4)
-    if header != b"Yaz0":
-        if suppress_error:
-            f.seek(0)
-            out.write(f.read())
-            return 
-        else:
-            raise RuntimeError("File is not Yaz0-compressed! Header: {0}".format(header))
-    
-    decompressed_size = read_uint32(f)
-    f.read(8) # padding
-        
-    eof = False
+def decompress_bytes(buffer):
+    data = memoryview(buffer)
+    if data[:4] != b"Yaz0":
+        raise RuntimeError("File is not Yaz0-compressed! Header: {0}".format(bytes(data[:4])))
 
-    # Some micro optimization, can save up to a second on bigger files
-    file_read = f.read
-    file_tell = f.tell
+    decompressed_size = unpack(">I", data[4:8])[0]
+    out = bytearray(decompressed_size)
 
-    out_read = out.read
-    out_write = out.write
-    out_tell = out.tell
-    out_seek = out.seek
+    src = 16 # Skip header and padding
+    dst = 0
+    src_end = len(data)
 
-    range_8 = [i for i in range(8)]
+    try:
+        while dst < decompressed_size:
+            code_byte = data[src]
+            src += 1
 
-    while out_tell() < decompressed_size and not eof:
-        code_byte = file_read(1)[0]
-        
-        for i in range_8:
-            #is_set = ((code_byte << i) & 0x80) != 0
-            
-            if (code_byte << i) & 0x80:
-                out_write(file_read(1)) # Write next byte as-is without requiring decompression
-            else:
-                if file_tell() >= maxsize-1:
-                    eof = True
-                    break
+            if code_byte == 0xFF and dst + 8 <= decompressed_size and src + 8 <= src_end:
+                # Eight literal bytes in a row, copy them in one go
+                out[dst:dst+8] = data[src:src+8]
+                src += 8
+                dst += 8
+                continue
 
-                data = file_read(2)
-                infobyte = data[0] << 8 | data[1]
-                
-
-                bytecount = infobyte >> 12 
-                
-                if bytecount == 0:
-                    if file_tell() > maxsize-1:
-                        eof = True
-                        break
-                    bytecount = file_read(1)[0] + 0x12
+            mask = 0x80
+            while mask and dst < decompressed_size:
+                if code_byte & mask:
+                    out[dst] = data[src] # Write next byte as-is without requiring decompression
+                    src += 1
+                    dst += 1
                 else:
-                    bytecount += 2
-                
-                offset = infobyte & 0x0FFF
-                
-                current = out_tell()
-                seekback = current - (offset+1)
-                
-                if seekback < 0:
-                    raise RuntimeError("Malformed Yaz0 file: Seek back position goes below 0")
-
-                out_seek(seekback)
-                copy = out_read(bytecount)
-                out_seek(current)
-                
-                write_limited(out, copy, decompressed_size)
-
-                copy_length = len(copy)
-                
-                if copy_length < bytecount:
-                    # Copy source and copy distance overlap which essentially means that
-                    # we have to repeat the copied source to make up for the difference
-                    j = 0
-                    for i in range(bytecount-copy_length):
-                        #write_limited(out, copy[j:j+1], decompressed_size)
-                        if out_tell() < decompressed_size:
-                            out_write(copy[j:j+1])
+                    byte1 = data[src]
+                    byte2 = data[src+1]
+                    src += 2
+
+                    bytecount = byte1 >> 4
+                    if bytecount == 0:
+                        bytecount = data[src] + 0x12
+                        src += 1
+                    else:
+                        bytecount += 2
+
+                    distance = ((byte1 & 0x0F) << 8 | byte2) + 1
+                    seekback = dst - distance
+                    if seekback < 0:
+                        raise RuntimeError("Malformed Yaz0 file: Seek back position goes below 0")
+
+                    if bytecount > decompressed_size - dst:
+                        bytecount = decompressed_size - dst
+
+                    if distance >= bytecount:
+                        out[dst:dst+bytecount] = out[seekback:seekback+bytecount]
+                    else:
+                        # Copy source and copy distance overlap which essentially means that
+                        # we have to repeat the copied source to make up for the difference
+                        pattern = out[seekback:dst]
+                        out[dst:dst+bytecount] = (pattern*(bytecount//distance + 1))[:bytecount]
+                    dst += bytecount
+
+                mask >>= 1
+    except IndexError:
+        raise RuntimeError("Didn't decompress correctly, Yaz0 data ended early "
+                           "({0}/{1} bytes decompressed)".format(dst, decompressed_size))
+
+    return out
+
+
+Yaz0Header = namedtuple("Yaz0Header", ["decompressed_size", "compressed_size"])
+
+
+def probe(f):
+    # Reads only the 16-byte header at the current position of f.
+    # Returns None if the data isn't Yaz0-compressed. The position of f is left unchanged.
+    start = f.tell()
+    header = f.read(16)
+    compressed_size = f.seek(0, 2) - start
+    f.seek(start)
+
+    if len(header) < 16 or header[:4] != b"Yaz0":
+        return None
+
+    return Yaz0Header(unpack(">I", header[4:8])[0], compressed_size)
+
+
+class Yaz0Reader(object):
+    # File-like object that decompresses Yaz0 data from f on demand.
+    # Only the last WINDOW_SIZE bytes of output (needed to resolve back-references) and the
+    # decompressed data that hasn't been read yet are kept in memory, so reading the start of
+    # a big compressed file is cheap and never requires decompressing all of it.
+    # Seeking forward decompresses and discards data, seeking backward restarts from the beginning.
+
+    INPUT_CHUNK_SIZE = 0x10000
+    MAX_GROUP_SIZE = 1 + 8*3 # Code byte followed by at most eight 3-byte back-references
+
+    def __init__(self, f):
+        self._f = f
+        self._start = f.tell()
+
+        header = f.read(16)
+        if header[:4] != b"Yaz0":
+            raise RuntimeError("File is not Yaz0-compressed! Header: {0}".format(header[:4]))
+        self.decompressed_size = unpack(">I", header[4:8])[0]
+
+        self._reset()
+
+    def _reset(self):
+        self._f.seek(self._start + 16)
+        self._input = b""
+        self._input_pos = 0
+        self._input_eof = False
+
+        self._buffer = bytearray()
+        self._buffer_pos = 0 # Position of the next unread byte in the buffer
+        self._decoded = 0 # Total number of bytes decompressed so far
+        self._pos = 0 # Total number of bytes read so far
+
+    def _fill_input(self):
+        if not self._input_eof and len(self._input) - self._input_pos < self.MAX_GROUP_SIZE:
+            chunk = self._f.read(self.INPUT_CHUNK_SIZE)
+            if not chunk:
+                self._input_eof = True
+            self._input = self._input[self._input_pos:] + chunk
+            self._input_pos = 0
+
+    def _decode(self, count):
+        # Decompresses at least count bytes (or until the end of the data) into the buffer.
+        buffer = self._buffer
+        target = min(self._decoded + count, self.decompressed_size)
+        decoded = self._decoded
+
+        try:
+            while decoded < target:
+                self._fill_input()
+                data = self._input
+                src = self._input_pos
+
+                code_byte = data[src]
+                src += 1
+                mask = 0x80
+                while mask and decoded < self.decompressed_size:
+                    if code_byte & mask:
+                        buffer.append(data[src])
+                        src += 1
+                        decoded += 1
+                    else:
+                        byte1 = data[src]
+                        byte2 = data[src+1]
+                        src += 2
+
+                        bytecount = byte1 >> 4
+                        if bytecount == 0:
+                            bytecount = data[src] + 0x12
+                            src += 1
                         else:
-                            break
+                            bytecount += 2
+
+                        distance = ((byte1 & 0x0F) << 8 | byte2) + 1
+                        if distance > decoded:
+                            raise RuntimeError("Malformed Yaz0 file: Seek back position goes below 0")
+
+                        bytecount = min(bytecount, self.decompressed_size - decoded)
+                        seekback = len(buffer) - distance
+
+                        if distance >= bytecount:
+                            buffer += buffer[seekback:seekback+bytecount]
+                        else:
+                            pattern = buffer[seekback:]
+                            buffer += (pattern*(bytecount//distance + 1))[:bytecount]
+                        decoded += bytecount
+
+                    mask >>= 1
+
+                self._input_pos = src
+        except IndexError:
+            raise RuntimeError("Didn't decompress correctly, Yaz0 data ended early "
+                               "({0}/{1} bytes decompressed)".format(decoded, self.decompressed_size))
+        finally:
+            self._decoded = decoded
+
+    def _trim(self):
+        # Drop everything but the window before the read position.
+        excess = self._buffer_pos - WINDOW_SIZE
+        if excess > 0:
+            del self._buffer[:excess]
+            self._buffer_pos -= excess
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.decompressed_size - self._pos
+
+        available = len(self._buffer) - self._buffer_pos
+        if available < size:
+            self._decode(size - available)
+
+        data = bytes(self._buffer[self._buffer_pos:self._buffer_pos+size])
+        self._buffer_pos += len(data)
+        self._pos += len(data)
+        self._trim()
 
-                        j = (j+1) % copy_length
-                
-    if out.tell() < decompressed_size:
-        log.debug("this isn't right")
-        raise RuntimeError("Didn't decompress correctly, notify the developer!")
-    if out.tell() > decompressed_size:
-        log.warning(f"Warning: output is longer than decompressed size for some reason: "
-                    f"{out.tell()}/decompressed: {decompressed_size}")
+        return data
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.decompressed_size
+        offset = max(0, min(offset, self.decompressed_size))
+
+        if offset < self._pos:
+            self._reset()
+
+        while self._pos < offset:
+            self.read(min(offset - self._pos, self.INPUT_CHUNK_SIZE))
+
+        return self._pos
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self._buffer = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def decompress(f, out, suppress_error=False):
+    #if out is None:
+    #    out = BytesIO()
+    f.seek(0)
+    data = f.read()
+
+    if data[:4] != b"Yaz0":
+        if suppress_error:
+            out.write(data)
+            return 
+        else:
+            raise RuntimeError("File is not Yaz0-compressed! Header: {0}".format(data[:4]))
+
+    out.write(decompress_bytes(data))
 
 
 def compress_fast(f, out):
@@ -161,3 +314,253 @@ def compress_fast(f, out):
         
         out_write(b"\xFF") # Set all bits in the code byte to 1 to mark the following 8 bytes as copy
         out_write(tocopy)
+
+
+# Yaz0 back-references can reach at most 0x1000 bytes back and copy 3 to 0x111 bytes.
+WINDOW_SIZE = 0x1000
+MIN_MATCH = 3
+MAX_MATCH = 0x111
+
+# Compression levels, similar in spirit to zlib's configuration table:
+# level: (maximum hash chain length to search, use lazy matching, match length that ends the search early)
+# Level 0 stores everything as literals.
+COMPRESSION_LEVELS = {
+    1: (4, False, 16),
+    2: (8, False, 32),
+    3: (16, False, 64),
+    4: (16, True, 32),
+    5: (32, True, 64),
+    6: (64, True, 128),
+    7: (128, True, MAX_MATCH),
+    8: (256, True, MAX_MATCH),
+    9: (1024, True, MAX_MATCH),
+}
+DEFAULT_LEVEL = 6
+
+
+def _match_length(data, candidate, pos, max_length):
+    # The first MIN_MATCH bytes are known to match because candidates come from the hash chain.
+    # Whether a prefix of a given length matches is monotonic in the length, so we can binary search
+    # using slice comparisons, which are done in C instead of a Python loop over every byte.
+    low = MIN_MATCH
+    high = max_length
+    while low < high:
+        mid = (low + high + 1) >> 1
+        if data[candidate:candidate+mid] == data[pos:pos+mid]:
+            low = mid
+        else:
+            high = mid - 1
+
+    return low
+
+
+def _find_match(data, pos, head, prev, max_chain, nice_length):
+    max_length = min(MAX_MATCH, len(data) - pos)
+    if max_length < MIN_MATCH:
+        return 0, 0
+
+    candidate = head.get(data[pos:pos+MIN_MATCH], -1)
+    window_start = pos - WINDOW_SIZE
+    best_length = MIN_MATCH - 1
+    best_pos = 0
+
+    while candidate >= 0 and candidate >= window_start and max_chain > 0:
+        # Cheap check before doing the full comparison: a longer match must also match at best_length.
+        if data[candidate+best_length] == data[pos+best_length]:
+            length = _match_length(data, candidate, pos, max_length)
+            if length > best_length:
+                best_length = length
+                best_pos = candidate
+                if length >= nice_length or length == max_length:
+                    break
+
+        candidate = prev[candidate]
+        max_chain -= 1
+
+    if best_length < MIN_MATCH:
+        return 0, 0
+    return best_length, best_pos
+
+
+def _insert_hashes(data, head, prev, start, end):
+    # Adds the positions in [start, end) to the hash chains.
+    end = min(end, len(data) - MIN_MATCH + 1)
+    for i in range(start, end):
+        key = data[i:i+MIN_MATCH]
+        prev[i] = head.get(key, -1)
+        head[key] = i
+
+
+def _compress_tokens(data, start=0, level=DEFAULT_LEVEL):
+    # Compresses data[start:] into a list of tokens, using data[:start] only as the window
+    # that back-references may point into.
+    # Returns one flag per token (1 for a literal, 0 for a back-reference) and the concatenated
+    # token bytes. Code bytes are added separately by _pack_tokens so that tokens from
+    # independently compressed segments can be joined into one stream.
+    size = len(data)
+    flags = bytearray()
+    payload = bytearray()
+
+    if level <= 0:
+        # Stored, every byte is a literal
+        flags += b"\x01"*(size - start)
+        payload += data[start:]
+        return flags, payload
+
+    max_chain, lazy, nice_length = COMPRESSION_LEVELS[min(level, max(COMPRESSION_LEVELS))]
+
+    # Hash chains over 3-byte sequences: head maps a sequence to the last position it was seen at,
+    # prev links every position to the previous position with the same sequence.
+    head = {}
+    prev = [-1]*size
+    _insert_hashes(data, head, prev, max(0, start - WINDOW_SIZE), start)
+    inserted = start
+
+    flags_append = flags.append
+    payload_append = payload.append
+
+    pos = start
+    match_length, match_pos = _find_match(data, pos, head, prev, max_chain, nice_length)
+
+    while pos < size:
+        if match_length and lazy and match_length < nice_length and pos + 1 < size:
+            # Lazy matching: if the next position has a longer match, emit a literal instead.
+            _insert_hashes(data, head, prev, inserted, pos + 1)
+            inserted = pos + 1
+            next_length, next_pos = _find_match(data, pos + 1, head, prev, max_chain, nice_length)
+            if next_length > match_length:
+                flags_append(1)
+                payload_append(data[pos])
+                pos += 1
+                match_length, match_pos = next_length, next_pos
+                continue
+
+        if match_length:
+            distance = pos - match_pos - 1
+            flags_append(0)
+            if match_length < 0x12:
+                payload_append(((match_length - 2) << 4) | (distance >> 8))
+                payload_append(distance & 0xFF)
+            else:
+                payload_append(distance >> 8)
+                payload_append(distance & 0xFF)
+                payload_append(match_length - 0x12)
+            pos += match_length
+        else:
+            flags_append(1)
+            payload_append(data[pos])
+            pos += 1
+
+        _insert_hashes(data, head, prev, inserted, pos)
+        inserted = max(inserted, pos)
+        match_length, match_pos = _find_match(data, pos, head, prev, max_chain, nice_length)
+
+    return flags, payload
+
+
+def _pack_tokens(out, flags, payload):
+    # Groups tokens by eight behind a code byte.
+    out_append = out.append
+    payload_pos = 0
+
+    for group_start in range(0, len(flags), 8):
+        code_byte = 0
+        mask = 0x80
+        token_start = payload_pos
+
+        for is_literal in flags[group_start:group_start+8]:
+            if is_literal:
+                code_byte |= mask
+                payload_pos += 1
+            elif payload[payload_pos] >> 4:
+                payload_pos += 2
+            else:
+                payload_pos += 3
+            mask >>= 1
+
+        out_append(code_byte)
+        out += payload[token_start:payload_pos]
+
+
+def _make_header(size):
+    return b"Yaz0" + pack(">I", size) + b"\x00"*8
+
+
+def _cache_setting(level):
+    return "yaz0-{0}".format(level)
+
+
+def compress_bytes(data, level=DEFAULT_LEVEL, cache=None):
+    data = bytes(data)
+
+    if cache is not None:
+        result = cache.get(data, _cache_setting(level))
+        if result is not None:
+            return result
+
+    out = bytearray(_make_header(len(data)))
+    flags, payload = _compress_tokens(data, 0, level)
+    _pack_tokens(out, flags, payload)
+    result = bytes(out)
+
+    if cache is not None:
+        cache.put(data, _cache_setting(level), result)
+
+    return result
+
+
+def compress(f, out, level=DEFAULT_LEVEL, cache=None):
+    out.write(compress_bytes(f.read(), level, cache))
+
+
+# Inputs are split into segments of at least this size for parallel compression,
+# smaller segments would spend more time on process overhead than on compression.
+MIN_SEGMENT_SIZE = 0x40000
+
+
+def _compress_segment(args):
+    data, start, level = args
+    return _compress_tokens(data, start, level)
+
+
+def compress_parallel(data, workers=None, level=DEFAULT_LEVEL, cache=None):
+    # Back-references only reach WINDOW_SIZE bytes back, so the input can be split into
+    # segments that are compressed independently on separate processes. Every segment is
+    # given the WINDOW_SIZE bytes preceding it so that matches can still cross segment
+    # boundaries, and the resulting tokens are joined into one valid stream.
+    data = bytes(data)
+    size = len(data)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    segment_size = max(MIN_SEGMENT_SIZE, -(-size // max(workers, 1)))
+    if workers <= 1 or size <= segment_size:
+        return compress_bytes(data, level, cache)
+
+    if cache is not None:
+        result = cache.get(data, _cache_setting(level))
+        if result is not None:
+            return result
+
+    jobs = []
+    for segment_start in range(0, size, segment_size):
+        window_start = max(0, segment_start - WINDOW_SIZE)
+        jobs.append((data[window_start:segment_start+segment_size], segment_start - window_start, level))
+
+    out = bytearray(_make_header(size))
+    flags = bytearray()
+    payload = bytearray()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for segment_flags, segment_payload in executor.map(_compress_segment, jobs):
+            flags += segment_flags
+            payload += segment_payload
+
+    _pack_tokens(out, flags, payload)
+    result = bytes(out)
+
+    if cache is not None:
+        cache.put(data, _cache_setting(level), result)
+
+    return result
@@ -0,0 +1,253 @@
+"""Round-trip, fuzz and throughput benchmark for the Yaz0 encoders and decoders.
+
+Builds synthetic corpora so that no game files are needed, checks that every encoder's output
+decompresses back to the input with every decoder and reports throughput and compression ratio
+per corpus as JSON, so results can be compared between revisions.
+
+Usage: python -m src.yaz0_benchmark [--size BYTES] [--levels 1,6,9] [--fuzz N] [--output results.json]
+"""
+
+import os
+import sys
+import json
+import random
+import platform
+import subprocess
+
+from io import BytesIO
+from timeit import default_timer as time
+
+from . import yaz0
+from .rarc import Archive, Directory, File
+
+
+def make_random(rng, size):
+    return bytes(rng.getrandbits(8) for _ in range(size))
+
+
+def make_repetitive(rng, size):
+    # A small vocabulary of "words" repeated in random order, like text or tables of similar values.
+    words = [make_random(rng, rng.randint(3, 12)) for _ in range(32)]
+    data = bytearray()
+    while len(data) < size:
+        data += rng.choice(words)
+    return bytes(data[:size])
+
+
+def make_overlapping_runs(rng, size):
+    # Short patterns repeated many times, which decode as back-references overlapping their own output.
+    data = bytearray()
+    while len(data) < size:
+        pattern = make_random(rng, rng.randint(1, 16))
+        data += pattern*(rng.randint(50, 2000)//len(pattern) + 1)
+    return bytes(data[:size])
+
+
+def make_rarc(rng, size):
+    # A real RARC archive holding a mix of small structured and random members, similar to course archives.
+    root = Directory("root")
+    total = 0
+    index = 0
+    while total < size:
+        dir = Directory("dir{0}".format(index))
+        dir.parent = root
+        root.subdirs[dir.name] = dir
+
+        for i in range(8):
+            kind = rng.randrange(3)
+            member_size = rng.randint(0x20, 0x4000)
+            if kind == 0:
+                member_data = make_repetitive(rng, member_size)
+            elif kind == 1:
+                member_data = make_random(rng, member_size)
+            else:
+                member_data = b"\x00"*member_size
+            file = File.from_file("file{0}_{1}.bin".format(index, i), BytesIO(member_data))
+            dir.files[file.name] = file
+            total += member_size
+        index += 1
+
+    arc = Archive()
+    arc.root = root
+    out = BytesIO()
+    arc.write_arc_uncompressed(out)
+    return out.getvalue()
+
+
+CORPORA = {
+    "random": make_random,
+    "repetitive": make_repetitive,
+    "overlapping_runs": make_overlapping_runs,
+    "rarc": make_rarc,
+}
+
+
+def encoders(levels, workers):
+    # compress_parallel only splits inputs larger than yaz0.MIN_SEGMENT_SIZE between more than one worker,
+    # at least two are used so that joining the segments is always checked.
+    if workers is None:
+        workers = max(2, os.cpu_count() or 1)
+
+    def compress_fast(data):
+        out = BytesIO()
+        yaz0.compress_fast(BytesIO(data), out)
+        return out.getvalue()
+
+    result = [("compress_fast", compress_fast)]
+    for level in levels:
+        result.append(("compress_bytes_{0}".format(level),
+                       lambda data, level=level: yaz0.compress_bytes(data, level)))
+    for level in levels:
+        result.append(("compress_parallel_{0}".format(level),
+                       lambda data, level=level: yaz0.compress_parallel(data, workers, level)))
+    return result
+
+
+def decoders():
+    def decompress(data):
+        out = BytesIO()
+        yaz0.decompress(BytesIO(data), out)
+        return out.getvalue()
+
+    def decompress_reader(data):
+        return yaz0.Yaz0Reader(BytesIO(data)).read()
+
+    return [
+        ("decompress", decompress),
+        ("decompress_bytes", lambda data: bytes(yaz0.decompress_bytes(data))),
+        ("Yaz0Reader", decompress_reader),
+    ]
+
+
+def megabytes_per_second(size, seconds):
+    if seconds <= 0:
+        return None
+    return round(size/seconds/(1024*1024), 3)
+
+
+def run_benchmark(size, levels, workers, seed):
+    results = []
+    failures = []
+
+    for corpus_name, make_corpus in CORPORA.items():
+        data = make_corpus(random.Random(seed), size)
+
+        for encoder_name, encode in encoders(levels, workers):
+            start = time()
+            compressed = encode(data)
+            compress_time = time() - start
+
+            result = {
+                "corpus": corpus_name,
+                "encoder": encoder_name,
+                "size": len(data),
+                "compressed_size": len(compressed),
+                "ratio": round(len(compressed)/len(data), 4),
+                "compress_mb_s": megabytes_per_second(len(data), compress_time),
+            }
+
+            for decoder_name, decode in decoders():
+                start = time()
+                decompressed = decode(compressed)
+                decompress_time = time() - start
+
+                result[decoder_name + "_mb_s"] = megabytes_per_second(len(data), decompress_time)
+                if decompressed != data:
+                    failures.append("{0}: {1} -> {2}".format(corpus_name, encoder_name, decoder_name))
+
+            results.append(result)
+            print("{corpus:>16} {encoder:>20} ratio {ratio:.4f}  compress {compress_mb_s} MB/s  "
+                  "decompress_bytes {decompress_bytes_mb_s} MB/s".format(**result), file=sys.stderr)
+
+    return results, failures
+
+
+def run_fuzz(cases, levels, seed):
+    # Round trips of small inputs of random sizes and kinds, and decoding of truncated and corrupted data,
+    # which must fail with a RuntimeError instead of another exception or returning bad data silently.
+    rng = random.Random(seed)
+    failures = []
+
+    for case in range(cases):
+        make_corpus = rng.choice(list(CORPORA.values())[:3])
+        data = make_corpus(rng, rng.randint(1, 0x3000))
+        level = rng.choice([0] + list(levels))
+
+        compressed = yaz0.compress_bytes(data, level)
+        for decoder_name, decode in decoders():
+            if decode(compressed) != data:
+                failures.append("fuzz case {0}: level {1} -> {2}".format(case, level, decoder_name))
+
+        corrupted = bytearray(compressed)
+        if rng.random() < 0.5:
+            corrupted = corrupted[:rng.randint(16, len(corrupted) - 1)] if len(corrupted) > 17 else corrupted
+        else:
+            for i in range(rng.randint(1, 8)):
+                corrupted[rng.randrange(16, len(corrupted))] = rng.getrandbits(8)
+
+        for decoder_name, decode in decoders():
+            try:
+                decompressed = decode(bytes(corrupted))
+            except RuntimeError:
+                pass
+            except Exception as error:
+                failures.append("fuzz case {0}: corrupted data -> {1} raised {2!r}".format(case, decoder_name, error))
+            else:
+                if len(decompressed) != len(data):
+                    failures.append("fuzz case {0}: corrupted data -> {1} returned wrong size".format(case, decoder_name))
+
+    return failures
+
+
+def get_revision():
+    try:
+        result = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except Exception:
+        return None
+    return result.stdout.strip()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default=4*yaz0.MIN_SEGMENT_SIZE, type=int,
+                        help=("Size in bytes of every corpus. compress_parallel only splits corpora larger than "
+                        "twice {0} bytes into more than one segment.".format(yaz0.MIN_SEGMENT_SIZE)))
+    parser.add_argument("--levels", default="1,{0},9".format(yaz0.DEFAULT_LEVEL),
+                        help="Comma-separated list of compression levels to benchmark.")
+    parser.add_argument("--workers", default=None, type=int,
+                        help="Number of processes for compress_parallel. Defaults to the number of CPU cores, but at least 2.")
+    parser.add_argument("--fuzz", default=200, type=int,
+                        help="Number of fuzz cases to run.")
+    parser.add_argument("--seed", default=0, type=int,
+                        help="Seed for generating the corpora and fuzz cases.")
+    parser.add_argument("--output", default=None,
+                        help="Path the JSON results are written to. Defaults to printing them.")
+
+    args = parser.parse_args()
+    levels = [int(level) for level in args.levels.split(",")]
+
+    results, failures = run_benchmark(args.size, levels, args.workers, args.seed)
+    failures.extend(run_fuzz(args.fuzz, levels, args.seed))
+
+    report = {
+        "revision": get_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "fuzz_cases": args.fuzz,
+        "results": results,
+        "failures": failures,
+    }
+
+    if args.output is None:
+        print(json.dumps(report, indent=4))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+    for failure in failures:
+        print("FAILED: " + failure, file=sys.stderr)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,172 @@
+import random
+import struct
+import zlib
+from io import BytesIO
+
+import pytest
+
+from src.disc_reader import open_disc, CISODiscReader, GCZDiscReader, CISO_HEADER_SIZE
+from src.gcm import GCM, split_name_table
+
+
+BLOCK_SIZE = 0x8000
+
+
+def make_iso(path):
+    # A small disc with a boot header, a DOL and a file system holding random, zero and empty files.
+    rng = random.Random(1)
+    image = bytearray(0x3000)
+    image[0:6] = b"GM4E01"
+    struct.pack_into(">I", image, 0x420, 0x2600) # DOL offset
+    struct.pack_into(">II", image, 0x2440+0x14, 0x100, 0) # Apploader size and trailer size
+    struct.pack_into(">I", image, 0x2600, 0x100) # DOL text0 offset and size
+    struct.pack_into(">I", image, 0x2600+0x90, 0x200)
+    image[0x2700:0x2900] = bytes(rng.getrandbits(8) for _ in range(0x200))
+
+    tree = [("dir", "Course", [("file", "a.arc", 5000), ("file", "b.bin", 70000),
+                               ("dir", "Sub", [("file", "zero.bin", 3*BLOCK_SIZE), ("file", "c.txt", 17)])]),
+            ("file", "top.bin", 40000), ("file", "empty.bin", 0)]
+    entries = [[1, 0, 0, None]]
+    names = bytearray()
+    file_data = []
+
+    def add(node, parent):
+        index = len(entries)
+        name_offset = len(names)
+        names.extend(node[1].encode("shift_jis") + b"\0")
+        if node[0] == "dir":
+            entries.append([1, name_offset, parent, None])
+            for child in node[2]:
+                add(child, index)
+            entries[index][3] = len(entries)
+        else:
+            size = node[2]
+            data = bytes(size) if node[1] == "zero.bin" else bytes(rng.getrandbits(8) for _ in range(size))
+            entries.append([0, name_offset, None, size])
+            file_data.append((index, data))
+
+    for node in tree:
+        add(node, 0)
+    entries[0][3] = len(entries)
+
+    fst_offset = len(image)
+    fst_size = len(entries)*12 + len(names)
+    struct.pack_into(">III", image, 0x424, fst_offset, fst_size, fst_size)
+    image += bytes(len(entries)*12) + names
+
+    for index, data in file_data:
+        image += bytes(-len(image) % BLOCK_SIZE)
+        entries[index][2] = len(image)
+        image += data
+    image += bytes(-len(image) % BLOCK_SIZE)
+
+    for i, (is_dir, name_offset, offset_or_parent, size_or_next) in enumerate(entries):
+        struct.pack_into(">III", image, fst_offset + i*12, (is_dir << 24) | name_offset, offset_or_parent,
+                         size_or_next)
+
+    path.write_bytes(image)
+    return bytes(image)
+
+
+def make_ciso(path, image, extra_zero_blocks=0):
+    # Compact ISO of the image, optionally with zero blocks after its end that aren't stored.
+    block_map = bytearray(CISO_HEADER_SIZE - 8)
+    stored = bytearray()
+    for i in range(0, len(image), BLOCK_SIZE):
+        block = image[i:i+BLOCK_SIZE]
+        if any(block):
+            block_map[i // BLOCK_SIZE] = 1
+            stored += block
+    path.write_bytes(b"CISO" + struct.pack("<I", BLOCK_SIZE) + block_map + stored)
+
+
+def decode_gcz(data):
+    # Decodes a GCZ file without using GCZDiscReader, checking every block's checksum.
+    magic, sub_type, compressed_size, disc_size, block_size, num_blocks = struct.unpack_from("<IIQQII", data)
+    assert magic == 0xB10BC001
+    offsets = struct.unpack_from("<%dQ" % num_blocks, data, 0x20)
+    checksums = struct.unpack_from("<%dI" % num_blocks, data, 0x20 + num_blocks*8)
+    base = 0x20 + num_blocks*12
+    assert len(data) == base + compressed_size
+
+    disc = bytearray()
+    for i, offset in enumerate(offsets):
+        start = offset & ~(1 << 63)
+        end = offsets[i+1] & ~(1 << 63) if i + 1 < num_blocks else compressed_size
+        block = data[base+start:base+end]
+        assert zlib.adler32(block) == checksums[i]
+        disc += block if offset >> 63 else zlib.decompress(block)
+    return bytes(disc[:disc_size])
+
+
+def read_files(path):
+    with GCM(str(path)) as iso:
+        iso.read_entire_disc()
+        return {file_path: iso.read_file_data(file_path).getvalue() for file_path in iso.files_by_path}
+
+
+@pytest.fixture
+def iso(tmp_path):
+    path = tmp_path / "disc.iso"
+    return path, make_iso(path)
+
+
+def export(input_path, output_path, gcz_path=None, **kwargs):
+    # Exports the disc with a changed and a new file, as an ISO and optionally as a GCZ.
+    with GCM(str(input_path)) as iso:
+        iso.read_entire_disc()
+        iso.changed_files["files/Course/Sub/c.txt"] = BytesIO(b"x"*12345)
+        if "files/new.bin" not in iso.files_by_path:
+            iso.add_new_file("files/new.bin", BytesIO(bytes(BLOCK_SIZE) + b"a"))
+        iso.export_disc_to_iso_with_changed_files(str(output_path), **kwargs)
+        if gcz_path is not None:
+            iso.export_disc_to_gcz_with_changed_files(str(gcz_path), block_size=0x4000)
+    return output_path.read_bytes()
+
+
+def test_split_name_table_skips_undecodable_names():
+    # Padding after the last name doesn't have to be valid Shift JIS
+    names = split_name_table(b"course.arc\0sys\0\xff\xff\0")
+    assert names[0] == "course.arc"
+    assert names[11] == "sys"
+    assert 15 not in names
+
+
+def test_gcz_export_round_trip(iso, tmp_path):
+    path, image = iso
+    exported = export(path, tmp_path / "out.iso", gcz_path=tmp_path / "out.gcz")
+    assert decode_gcz((tmp_path / "out.gcz").read_bytes()) == exported
+
+    with open_disc(str(tmp_path / "out.gcz")) as disc:
+        assert isinstance(disc, GCZDiscReader)
+        assert disc.size == len(exported)
+        assert bytes(disc.read(0, disc.size)) == exported
+        assert bytes(disc.read(disc.size - 4, 8)) == exported[-4:] + bytes(4)
+
+    assert read_files(tmp_path / "out.gcz") == read_files(tmp_path / "out.iso")
+    assert read_files(tmp_path / "out.iso")["files/new.bin"] == bytes(BLOCK_SIZE) + b"a"
+
+
+def test_export_from_gcz_matches_export_from_iso(iso, tmp_path):
+    path, image = iso
+    export(path, tmp_path / "source.iso", gcz_path=tmp_path / "source.gcz")
+    from_iso = export(tmp_path / "source.iso", tmp_path / "a.iso")
+    assert export(tmp_path / "source.gcz", tmp_path / "b.iso") == from_iso
+    assert export(tmp_path / "source.gcz", tmp_path / "c.iso", workers=1, skip_zero_blocks=True) == from_iso
+
+
+@pytest.mark.parametrize("extra_zero_blocks", [0, 3])
+def test_ciso_reader(iso, tmp_path, extra_zero_blocks):
+    path, image = iso
+    ciso_path = tmp_path / "disc.ciso"
+    make_ciso(ciso_path, image + bytes(extra_zero_blocks*BLOCK_SIZE))
+
+    with open_disc(str(ciso_path)) as disc:
+        assert isinstance(disc, CISODiscReader)
+        # Trailing zero blocks aren't stored, the disc ends with the last stored block
+        assert disc.size == len(image)
+        assert bytes(disc.read(0, disc.size)) == image
+        assert bytes(disc.read(disc.size, BLOCK_SIZE)) == bytes(BLOCK_SIZE)
+
+    assert read_files(ciso_path) == read_files(path)
+    assert export(ciso_path, tmp_path / "a.iso") == export(path, tmp_path / "b.iso")
@@ -0,0 +1,225 @@
+from io import BytesIO
+from struct import pack_into, unpack_from
+
+import pytest
+
+from src.rarc import Archive, CompressionSetting, Directory, File
+from src.yaz0 import compress_bytes, decompress_bytes
+
+
+def make_file(name, data):
+    return File.from_file(name, BytesIO(data))
+
+
+def make_archive():
+    arc = Archive()
+    arc.root = Directory("root")
+    arc.root.files["a.bin"] = make_file("a.bin", b"a"*0x30)
+    return arc
+
+
+def test_index_follows_changes_in_attached_subdir():
+    arc = make_archive()
+    sub = Directory("sub")
+    sub.files["f"] = make_file("f", b"f")
+    arc.root.subdirs["sub"] = sub # parent isn't set by the caller
+    assert sub.parent is arc.root
+    assert arc.find("root/sub/f") is sub.files["f"]
+
+    del sub.files["f"]
+    assert arc.find("root/sub/f") is None
+    assert not arc.exists("root/sub/f")
+    with pytest.raises(FileNotFoundError):
+        arc["root/sub/f"]
+
+    g = make_file("G", b"g")
+    sub.files["G"] = g
+    assert arc["root/sub/G"] is g
+    assert arc.find("ROOT/SUB/g", ignore_case=True) is g
+
+
+def test_index_matches_full_rebuild():
+    arc = make_archive()
+    arc.find("root")
+
+    sub = Directory("sub")
+    arc.root.subdirs["sub"] = sub
+    sub.subdirs["deep"] = Directory("deep")
+    sub.subdirs["deep"].files["x"] = make_file("x", b"x")
+    sub.subdirs["renamed"] = sub.subdirs.pop("deep")
+    sub.files["X"] = make_file("X", b"X")
+    arc.root.files.pop("a.bin")
+    incremental = dict(arc._entries_by_path), dict(arc._entries_by_path_lowercase)
+
+    arc._index_key = None
+    arc.find("root")
+    assert incremental == (arc._entries_by_path, arc._entries_by_path_lowercase)
+    assert arc.find("root/sub/renamed/x") is not None
+    assert arc.find("root/sub/deep/x") is None
+
+
+def test_index_after_root_rename():
+    arc = make_archive()
+    assert arc.exists("root/a.bin")
+    arc.root.name = "other"
+    assert not arc.exists("root/a.bin")
+    assert arc.exists("other/a.bin")
+
+
+class FailingWriter(BytesIO):
+    def write(self, data):
+        if self.tell() > 0x40:
+            raise OSError("disk full")
+        return super().write(data)
+
+
+def test_failed_write_releases_file_buffers():
+    arc = make_archive()
+    with pytest.raises(OSError) as error:
+        arc.write_arc_uncompressed(FailingWriter())
+
+    # The traceback keeps the frame of write_arc alive, along with any views of the file's buffer it didn't release
+    assert error.traceback
+    file = arc["root/a.bin"]
+    file.seek(0, 2)
+    file.write(b"more")
+    file.truncate(4)
+    assert file.getvalue() == b"aaaa"
+
+
+def test_peek_reads_start_of_spilled_file(tmp_path):
+    path = tmp_path / "big.bin"
+    path.write_bytes(b"Yaz0" + b"\x00"*0x100)
+    file = File.from_path("big.bin", str(path))
+    assert file.peek(4) == b"Yaz0"
+    assert file.is_spilled()
+    assert make_file("small", b"ab").peek(4) == b"ab"
+
+
+def test_compress_members_keeps_order():
+    files = [make_file("f{0}".format(i), bytes([i])*(0x100 + i*0x40)) for i in range(9)]
+    results = CompressionSetting(yaz0=True, yaz0_level=1, workers=2).compress_members(files)
+    assert [bytes(decompress_bytes(data)) for data in results] == [file.getvalue() for file in files]
+
+
+def test_read_yaz0_compressed_archive():
+    arc = make_archive()
+    out = BytesIO()
+    arc.write_arc_compressed(out, CompressionSetting(yaz0=True, yaz0_level=1, workers=1))
+    out.seek(0)
+    assert Archive.from_file(out)["root/a.bin"].getvalue() == b"a"*0x30
+
+    with pytest.raises(RuntimeError):
+        Archive.from_file(BytesIO(compress_bytes(b"NOPE" + b"\x00"*0x40, 1)))
+
+
+def make_splice_archive():
+    # Files of several sizes, an empty file, and a subdirectory, written and read back lazily
+    arc = Archive()
+    arc.root = Directory("root")
+    for name, data in (("a.bin", b"a"*0x30), ("empty.bin", b""), ("b.bin", b"b"*0x45), ("c.bin", b"c"*0x20)):
+        arc.root.files[name] = make_file(name, data)
+    sub = Directory("sub")
+    arc.root.subdirs["sub"] = sub
+    sub.files["d.bin"] = make_file("d.bin", b"d"*0x100)
+
+    out = BytesIO()
+    arc.write_arc_uncompressed(out)
+    return out.getvalue()
+
+
+def read_contents(data):
+    arc = Archive.from_file(BytesIO(data))
+    contents = {}
+    for dir in arc.root.walk_dirs():
+        for name, file in dir.files.items():
+            contents[dir.absolute_path() + "/" + name] = file.getvalue()
+    return contents
+
+
+def splice(source, changes, in_place):
+    arc = Archive.from_file(BytesIO(source), lazy=True)
+    for path, data in changes.items():
+        file = arc[path]
+        file.seek(0)
+        file.truncate(0)
+        file.write(data)
+
+    expected = BytesIO()
+    arc.write_arc_uncompressed(expected)
+
+    if in_place:
+        out = BytesIO(source)
+        arc.write_arc_incremental(out, in_place=True)
+    else:
+        out = BytesIO()
+        arc.write_arc_incremental(out)
+    return out.getvalue(), expected.getvalue()
+
+
+@pytest.mark.parametrize("in_place", [False, True])
+@pytest.mark.parametrize("changes", [
+    {},
+    {"root/a.bin": b"A"*0x10}, # Fits into the old slot
+    {"root/a.bin": b"A"*0x50}, # Moves everything after it
+    {"root/empty.bin": b"E"*3, "root/b.bin": b"B"*0x90},
+    {"root/c.bin": b"", "root/sub/d.bin": b"D"*0x101},
+])
+def test_incremental_write_matches_full_write(changes, in_place):
+    source = make_splice_archive()
+    spliced, expected = splice(source, changes, in_place)
+
+    contents = read_contents(source)
+    contents.update(changes)
+    assert read_contents(spliced) == contents
+    assert read_contents(expected) == contents
+
+
+@pytest.mark.parametrize("in_place", [False, True])
+def test_incremental_write_empty_file_sharing_offset(in_place):
+    # An empty file with a higher entry index than the file whose offset it shares
+    source = bytearray(make_splice_archive())
+    file_entry_offset = unpack_from(">I", source, 0x2C)[0] + 0x20
+    pack_into(">II", source, file_entry_offset + 20*3 + 8, 0, 0) # c.bin is empty and at the offset of a.bin
+    source = bytes(source)
+
+    changes = {"root/a.bin": b"A"*0x50, "root/c.bin": b"C"*5}
+    spliced, expected = splice(source, changes, in_place)
+
+    contents = read_contents(source)
+    contents.update(changes)
+    assert read_contents(spliced) == contents
+
+
+def test_incremental_write_in_place_on_yaz0_source():
+    source = compress_bytes(make_splice_archive(), 1)
+    arc = Archive.from_file(BytesIO(source), lazy=True)
+    arc["root/a.bin"].write(b"X")
+
+    out = BytesIO(source)
+    arc.write_arc_incremental(out, in_place=True)
+    assert read_contents(out.getvalue())["root/a.bin"] == b"X" + b"a"*0x2F
+
+
+def test_incremental_write_after_structure_change():
+    source = make_splice_archive()
+    arc = Archive.from_file(BytesIO(source), lazy=True)
+    arc.root.files["new.bin"] = make_file("new.bin", b"n")
+
+    out = BytesIO(source)
+    arc.write_arc_incremental(out, in_place=True)
+    assert read_contents(out.getvalue())["root/new.bin"] == b"n"
+
+
+def test_index_paths_differing_in_case():
+    arc = make_archive()
+    upper = make_file("A.BIN", b"A")
+    arc.root.files["A.BIN"] = upper
+    lower = arc.root.files["a.bin"]
+    assert arc.find("root/a.bin") is lower
+    assert arc.find("root/A.BIN") is upper
+
+    # Removing the entry found when ignoring case must leave the other one findable
+    removed = arc.find("ROOT/A.bin", ignore_case=True)
+    del arc.root.files[removed.name]
+    assert arc.find("ROOT/A.bin", ignore_case=True) is (lower if removed is upper else upper)